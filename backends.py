@@ -0,0 +1,195 @@
+import os
+import re
+from abc import ABC, abstractmethod
+
+from .planner import TOTAL_RE, guess_page_type
+from .instrumentation import span
+
+# "auto" routes each page by confidence, "gemini" always uses Gemini, "local" never calls it.
+EXTRACTION_ROUTING = os.getenv("EXTRACTION_ROUTING", "auto")
+LOCAL_MIN_CONFIDENCE = float(os.getenv("LOCAL_MIN_CONFIDENCE", "0.9"))
+LOCAL_MIN_ROWS = int(os.getenv("LOCAL_MIN_ROWS", "2"))
+LOCAL_AMOUNT_TOLERANCE = float(os.getenv("LOCAL_AMOUNT_TOLERANCE", "0.01"))
+
+ZERO_USAGE = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+
+NUMBER_TOKEN_RE = re.compile(r"^(?:rs\.?|inr|₹)?(\d{1,3}(?:,\d{2,3})+|\d+)(\.\d+)?/?-?$", re.IGNORECASE)
+AMOUNT_TOKEN_RE = re.compile(r"\d[.,]\d{2}$")
+SERIAL_RE = re.compile(r"^\s*\d{1,3}\s*[.)]?\s+")
+NON_ITEM_RE = re.compile(
+    r"sub\s*-?\s*total|balance|amount\s+due|round(?:ed)?\s*off|advance|amount\s+in\s+words|paid|"
+    r"\bcgst\b|\bsgst\b|\bigst\b|\btax\b|discount",
+    re.IGNORECASE,
+)
+# Tax and discount lines change what the items add up to; only the model can apply them.
+ADJUSTMENT_RE = re.compile(r"\bcgst\b|\bsgst\b|\bigst\b|\bgst\b|\bvat\b|\btax\b|discount|\bless\b", re.IGNORECASE)
+HEADER_ONLY_RE = re.compile(r"^[\W_]*(?:s\.?\s*no|sl|sr)\b", re.IGNORECASE)
+
+
+class ExtractionBackend(ABC):
+    """
+    A way of extracting the line items of a run of pages. `extract` gets a loader for the
+    PDF bytes of the pages and their content hashes, and returns (data, token_usage) in
+    the same shape as Gemini results; `confidence` says how sure the
+    backend is that it can extract a page correctly on its own.
+    """
+
+    name = ""
+
+    @abstractmethod
+    def confidence(self, text: str, source: str) -> float:
+        ...
+
+    @abstractmethod
+    async def extract(self, load_pages, page_hashes: list[str], mime_type: str, page_texts: list[str],
+                      first_page: int) -> tuple[dict, dict]:
+        ...
+
+
+def _number(token: str) -> float | None:
+    match = NUMBER_TOKEN_RE.match(token)
+    if match is None:
+        return None
+    return float(match.group(1).replace(",", "") + (match.group(2) or ""))
+
+
+def _close(a: float, b: float) -> bool:
+    return abs(a - b) <= max(0.05, LOCAL_AMOUNT_TOLERANCE * abs(b))
+
+
+def _parse_row(line: str) -> dict | None:
+    """
+    Reads `[serial] name ... [qty] [rate] amount` from one table line. The trailing
+    numbers are matched so that rate x quantity = amount; `validated` says whether that held.
+    Numbers left of the match stay in the name ("Paracetamol 500"); a row with unmatched
+    numbers between or after the matched ones is not validated.
+    """
+    tokens = line.split()
+    numbers, raw = [], []
+    while tokens:
+        value = _number(tokens[-1])
+        if value is None:
+            break
+        raw.insert(0, tokens.pop())
+        numbers.insert(0, value)
+    name = SERIAL_RE.sub("", " ".join(tokens)).strip(" :-|")
+    if not numbers or len(name) < 2 or not any(c.isalpha() for c in name) or HEADER_ONLY_RE.match(name):
+        return None
+    amount = numbers[-1]
+    row = {"item_name": name, "item_amount": amount, "item_rate": None, "item_quantity": 1, "validated": False}
+    rest = numbers[:-1]
+
+    def with_name_numbers(first: int) -> str:
+        return " ".join([name] + raw[:first])
+
+    # Adjacent pairs first: "qty rate amount" or "rate qty amount".
+    pairs = [(i, i + 1) for i in range(len(rest) - 2, -1, -1)] + [
+        (i, j) for i in range(len(rest)) for j in range(i + 2, len(rest))
+    ]
+    for i, j in pairs:
+        a, b = rest[i], rest[j]
+        if _close(a * b, amount):
+            quantity, rate = (a, b) if a.is_integer() and (not b.is_integer() or a <= b) else (b, a)
+            row.update(item_name=with_name_numbers(i), item_rate=rate, item_quantity=quantity,
+                       validated=j == i + 1 and j == len(rest) - 1)
+            return row
+    if rest and _close(rest[-1], amount):
+        row.update(item_name=with_name_numbers(len(rest) - 1), item_rate=rest[-1], validated=True)
+    return row
+
+
+def analyze_page(text: str) -> dict:
+    """
+    Rule-based table extraction from a page's OCR or text-layer text. Returns the rows,
+    the page total if one was found, and a 0-1 confidence: the share of rows whose
+    rate x quantity matches the amount, times the share of amount-bearing lines that
+    were read as rows, discounted unless the rows add up to a printed total. Pages with
+    tax or discount lines get no confidence.
+    """
+    rows, totals, candidates, adjusted = [], [], 0, False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or not any(c.isdigit() for c in line):
+            continue
+        if ADJUSTMENT_RE.search(line):
+            adjusted = True
+        if TOTAL_RE.search(line) or NON_ITEM_RE.search(line):
+            if TOTAL_RE.search(line):
+                numbers = [_number(t) for t in line.split()]
+                totals.extend(n for n in numbers if n is not None)
+            continue
+        if not AMOUNT_TOKEN_RE.search(line.split()[-1]):
+            continue
+        candidates += 1
+        row = _parse_row(line)
+        if row is not None:
+            rows.append(row)
+
+    if len(rows) < LOCAL_MIN_ROWS or adjusted:
+        return {"rows": rows, "total": None, "confidence": 0.0}
+    validated = sum(1 for row in rows if row["validated"]) / len(rows)
+    coverage = len(rows) / candidates
+    amount_sum = sum(row["item_amount"] for row in rows)
+    total = next((t for t in totals if _close(amount_sum, t)), None)
+    confidence = validated * coverage * (1.0 if total is not None else 0.85)
+    return {"rows": rows, "total": total, "confidence": round(confidence, 3)}
+
+
+class LocalTableBackend(ExtractionBackend):
+    """
+    Deterministic extractor for clean tables: reads rows from the page text and
+    validates them with rate x quantity = amount. No network, no tokens.
+    """
+
+    name = "local"
+
+    def confidence(self, text: str, source: str) -> float:
+        confidence = analyze_page(text)["confidence"]
+        # OCR misreads digits more often than a text layer.
+        return confidence * 0.95 if source != "text_layer" else confidence
+
+    async def extract(self, load_pages, page_hashes, mime_type, page_texts, first_page):
+        pages = []
+        with span("local_extract"):
+            for offset, text in enumerate(page_texts):
+                rows = analyze_page(text)["rows"]
+                pages.append({
+                    "page_no": str(first_page + offset),
+                    "page_type": guess_page_type(text),
+                    "bill_items": [{k: v for k, v in row.items() if k != "validated"} for row in rows],
+                })
+        return {
+            "pagewise_line_items": pages,
+            "total_item_count": sum(len(page["bill_items"]) for page in pages),
+        }, dict(ZERO_USAGE)
+
+
+class BackendRouter:
+    """
+    Picks a backend per page. Backends are tried cheapest first and a page goes to the
+    first one confident enough (LOCAL_MIN_CONFIDENCE); the last backend is the default.
+    With EXTRACTION_ROUTING=gemini or local every page goes to that backend.
+    """
+
+    def __init__(self, backends: list[ExtractionBackend], mode: str = EXTRACTION_ROUTING,
+                 min_confidence: float = LOCAL_MIN_CONFIDENCE):
+        self.backends = {backend.name: backend for backend in backends}
+        self.order = [backend.name for backend in backends]
+        self.mode = mode
+        self.min_confidence = min_confidence
+
+    def choose(self, text: str, source: str) -> str:
+        if self.mode in self.backends:
+            return self.mode
+        if source != "ocr_failed":
+            for name in self.order[:-1]:
+                if self.backends[name].confidence(text, source) >= self.min_confidence:
+                    return name
+        return self.order[-1]
+
+    def route(self, page_texts: list[str], text_sources: list[str]) -> list[str]:
+        with span("route"):
+            return [self.choose(text, source) for text, source in zip(page_texts, text_sources)]
+
+    def get(self, name: str) -> ExtractionBackend:
+        return self.backends[name]
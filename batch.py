@@ -0,0 +1,109 @@
+import os
+import asyncio
+
+from .extractor import iter_file, collect_events, ZERO_USAGE
+from .cache import hash_source
+from .scheduler import new_request_id, GEMINI_MAX_CONCURRENCY
+from .utils import download_document
+from .memory import memory_budget, estimate_document_memory
+from .instrumentation import span
+
+BATCH_MAX_DOCUMENTS = int(os.getenv("BATCH_MAX_DOCUMENTS", "500"))
+BATCH_DOWNLOAD_CONCURRENCY = int(os.getenv("BATCH_DOWNLOAD_CONCURRENCY", "16"))
+BATCH_DOCUMENT_CONCURRENCY = int(os.getenv("BATCH_DOCUMENT_CONCURRENCY", "8"))
+BATCH_GEMINI_CONCURRENCY = int(os.getenv("BATCH_GEMINI_CONCURRENCY", str(GEMINI_MAX_CONCURRENCY)))
+
+
+async def process_batch(urls: list[str]) -> list[dict]:
+    """
+    Extracts many documents in one call and returns one result dict per input URL, in order.
+
+    Every URL is pipelined on its own: downloaded, hashed and extracted, and its document
+    closed as soon as it is done. Identical URLs are downloaded once and identical bytes
+    are extracted once; repeats reuse the first result and report zero token usage. All Gemini calls of the batch share
+    one scheduling scope, so the batch gets a single fair share of the scheduler (up to
+    BATCH_GEMINI_CONCURRENCY calls) next to other requests. A failing document only fails
+    its own result.
+    """
+    if len(urls) > BATCH_MAX_DOCUMENTS:
+        raise ValueError(f"Batch too large: {len(urls)} documents (max {BATCH_MAX_DOCUMENTS}).")
+
+    new_request_id(limit=BATCH_GEMINI_CONCURRENCY)
+    unique_urls = list(dict.fromkeys(urls))
+    download_slots = asyncio.Semaphore(BATCH_DOWNLOAD_CONCURRENCY)
+    document_slots = asyncio.Semaphore(BATCH_DOCUMENT_CONCURRENCY)
+    # Downloaded documents waiting for a document slot are bounded too.
+    buffered_slots = asyncio.Semaphore(BATCH_DOWNLOAD_CONCURRENCY + BATCH_DOCUMENT_CONCURRENCY)
+    extractions = {}
+
+    async def extract(document, doc_hash: str, reservation):
+        async with document_slots:
+            return await collect_events(iter_file(document, doc_hash, reservation=reservation))
+
+    def close(document, reservation):
+        document.close()
+        buffered_slots.release()
+        if reservation is not None:
+            asyncio.ensure_future(reservation.release())
+
+    async def run(url: str):
+        """
+        Downloads, hashes and extracts one URL as soon as it can. A document whose bytes
+        are already being extracted is closed right away and shares that extraction.
+        """
+        reservation = None
+
+        async def reserve(content_length: int | None):
+            nonlocal reservation
+            reservation = await memory_budget.reserve(estimate_document_memory(content_length))
+
+        await buffered_slots.acquire()
+        try:
+            async with download_slots:
+                with span("download"):
+                    document = await download_document(url, on_headers=reserve)
+            try:
+                doc_hash = await asyncio.to_thread(hash_source, document.source)
+            except Exception:
+                document.close()
+                raise
+        except BaseException:
+            buffered_slots.release()
+            if reservation is not None:
+                await reservation.release()
+            raise
+
+        if doc_hash in extractions:
+            close(document, reservation)
+        else:
+            task = extractions[doc_hash] = asyncio.ensure_future(extract(document, doc_hash, reservation))
+            # Runs even if the task is cancelled before it starts.
+            task.add_done_callback(lambda _: close(document, reservation))
+        return doc_hash, await asyncio.shield(extractions[doc_hash])
+
+    try:
+        outcomes = await asyncio.gather(*[run(url) for url in unique_urls], return_exceptions=True)
+    finally:
+        for task in extractions.values():
+            task.cancel()
+    processed = dict(zip(unique_urls, outcomes))
+
+    results = []
+    reported = set()
+    for url in urls:
+        result = {"document": url, "is_success": False, "deduplicated": False}
+        outcome = processed[url]
+        if isinstance(outcome, BaseException):
+            result["message"] = f"Failed to process document. {outcome}"
+            results.append(result)
+            continue
+
+        doc_hash, (data, usage, metadata) = outcome
+        result.update(is_success=True, data=data, metadata=metadata)
+        if doc_hash in reported:
+            result.update(deduplicated=True, token_usage=dict(ZERO_USAGE))
+        else:
+            reported.add(doc_hash)
+            result["token_usage"] = usage
+        results.append(result)
+    return results
@@ -0,0 +1,327 @@
+"""
+Offline benchmark of the extraction pipeline.
+
+Runs process_document over the bundled sample PDFs with Gemini replaced by the
+local stub in mock_gemini.py, at several concurrency levels, and reports throughput,
+latency percentiles, peak RSS, CPU time and per-stage wall and CPU time. Results are
+compared against benchmark_baseline.json to catch performance regressions. The baseline
+depends on the machine (cores, Tesseract, Poppler), so it is not committed: create it
+with --save-baseline on the machine you compare on.
+
+Usage (from the directory containing bill_extractor/):
+    python -m bill_extractor.benchmark                    # run and compare with the baseline
+    python -m bill_extractor.benchmark --save-baseline    # run and store a new baseline
+    python -m bill_extractor.benchmark --levels 1,8 --latency 0.2 --error-rate 0.1 --malformed-rate 0.1
+
+Prompt/OCR-context variants can be compared for input tokens, and with --live (real
+Gemini, needs GEMINI_API_KEY) for accuracy against a reference run:
+    python -m bill_extractor.benchmark --live --levels 1 --prompt-variant full --ocr-context full --output full.json
+    python -m bill_extractor.benchmark --live --levels 1 --prompt-variant compact --ocr-context trimmed --reference full.json
+"""
+import os
+
+# Measure real work on every run: no cross-run result cache, and keep debug output out of the repo.
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+os.environ.setdefault("DEBUG_LOG_PATH", os.devnull)
+
+import sys
+import json
+import glob
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import threading
+from urllib.parse import quote
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+from . import extractor
+from . import ocr
+from .mock_gemini import MockConfig, install
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(REPO_DIR, "benchmark_baseline.json")
+SAMPLE_PATTERNS = ["train_sample_*.pdf", "Sample Document *.pdf", "SAmple Document *.pdf"]
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_sample_server():
+    """
+    Serves the repository directory on a random local port so the download stage is exercised.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=REPO_DIR))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def sample_files() -> list[str]:
+    files = set()
+    for pattern in SAMPLE_PATTERNS:
+        files.update(os.path.basename(p) for p in glob.glob(os.path.join(REPO_DIR, pattern)))
+    return sorted(files)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def document_summary(data: dict) -> dict:
+    items = [item for page in data["pagewise_line_items"] for item in page.get("bill_items", [])]
+    return {
+        "items": len(items),
+        "amount": round(sum(item.get("item_amount") or 0 for item in items), 2),
+    }
+
+
+async def run_level(urls: list[str], concurrency: int, config: MockConfig) -> dict:
+    ocr._memo.clear()
+    config.calls = config.uploads = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    stage_seconds = {}
+    stage_cpu_seconds = {}
+    tokens = 0
+    input_tokens = 0
+    documents = {}
+    failures = 0
+    peak_rss = current_rss_mb()
+    done = asyncio.Event()
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, current_rss_mb())
+            await asyncio.sleep(0.05)
+
+    async def one(url: str):
+        nonlocal tokens, input_tokens, failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                data, usage, metadata = await extractor.process_document(url)
+                tokens += usage["total_tokens"]
+                input_tokens += usage["input_tokens"]
+                documents[url.rsplit("/", 1)[-1]] = document_summary(data)
+                for stage, timing in metadata.get("timings", {}).items():
+                    stage_seconds[stage] = stage_seconds.get(stage, 0.0) + timing["seconds"]
+                    stage_cpu_seconds[stage] = stage_cpu_seconds.get(stage, 0.0) + timing["cpu_seconds"]
+            except Exception as e:
+                print(f"  [FAIL] {url}: {e}")
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    sampler = asyncio.create_task(sample_rss())
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    await asyncio.gather(*[one(url) for url in urls])
+    wall = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu_start
+    done.set()
+    await sampler
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(urls),
+        "failures": failures,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(urls) / wall, 3) if wall else 0.0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_p99": round(percentile(latencies, 99), 3),
+        "peak_rss_mb": round(peak_rss, 1),
+        "cpu_seconds": round(cpu, 3),
+        "stage_seconds": {stage: round(v, 3) for stage, v in sorted(stage_seconds.items())},
+        "stage_cpu_seconds": {stage: round(v, 3) for stage, v in sorted(stage_cpu_seconds.items())},
+        "gemini_calls": config.calls,
+        "uploads": config.uploads,
+        "total_tokens": tokens,
+        "input_tokens": input_tokens,
+        "documents": dict(sorted(documents.items())),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns a description of every metric that got worse than the baseline by more than `tolerance`.
+    """
+    regressions = []
+    base_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    for level in results["levels"]:
+        base = base_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        for key in ("latency_p50", "latency_p95", "latency_p99", "peak_rss_mb", "cpu_seconds"):
+            if base[key] and level[key] > base[key] * (1 + tolerance):
+                regressions.append(f"c={level['concurrency']} {key}: {base[key]} -> {level[key]}")
+        if base["throughput_rps"] and level["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"c={level['concurrency']} throughput_rps: {base['throughput_rps']} -> {level['throughput_rps']}")
+        if level["failures"] > base["failures"]:
+            regressions.append(f"c={level['concurrency']} failures: {base['failures']} -> {level['failures']}")
+    return regressions
+
+
+def compare_accuracy(results: dict, reference: dict, tolerance: float = 0.01) -> dict:
+    """
+    Compares per-document item counts and amount totals with a reference run
+    (typically the full prompt and OCR context) and the input tokens of both runs.
+    """
+    docs = results["levels"][0]["documents"]
+    ref_docs = reference["levels"][0]["documents"]
+    common = sorted(set(docs) & set(ref_docs))
+    same_items = sum(1 for name in common if docs[name]["items"] == ref_docs[name]["items"])
+    same_amount = sum(1 for name in common
+                      if abs(docs[name]["amount"] - ref_docs[name]["amount"]) <= tolerance * max(1, abs(ref_docs[name]["amount"])))
+    ref_tokens = reference["levels"][0]["input_tokens"]
+    tokens = results["levels"][0]["input_tokens"]
+    return {
+        "documents": len(common),
+        "same_item_count": same_items,
+        "same_amount_total": same_amount,
+        "input_tokens": tokens,
+        "reference_input_tokens": ref_tokens,
+        "input_tokens_saved_pct": round(100 * (ref_tokens - tokens) / ref_tokens, 1) if ref_tokens else 0.0,
+    }
+
+
+async def run(args) -> dict:
+    extractor.PROMPT_VARIANT = args.prompt_variant
+    ocr.OCR_CONTEXT_MODE = args.ocr_context
+    config = MockConfig(latency=args.latency, jitter=args.jitter, upload_latency=args.upload_latency,
+                        error_rate=args.error_rate, malformed_rate=args.malformed_rate, seed=args.seed)
+    if not args.live:
+        install(extractor, config)
+    server, base_url = start_sample_server()
+    try:
+        files = sample_files()
+        urls = [f"{base_url}/{quote(name)}" for name in files] * args.repeat
+        print(f"Benchmarking {len(files)} sample files x{args.repeat} at concurrency {args.levels}...")
+
+        levels = []
+        for concurrency in args.levels:
+            result = await run_level(urls, concurrency, config)
+            print(f"  c={concurrency}: {result['throughput_rps']} req/s, p50 {result['latency_p50']}s, "
+                  f"p95 {result['latency_p95']}s, p99 {result['latency_p99']}s, peak RSS {result['peak_rss_mb']} MB, "
+                  f"{result['input_tokens']} input tokens")
+            busiest = sorted(result["stage_cpu_seconds"].items(), key=lambda item: -item[1])[:5]
+            print("    CPU by stage: " + ", ".join(f"{stage} {seconds}s" for stage, seconds in busiest))
+            levels.append(result)
+    finally:
+        server.shutdown()
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "tesseract": shutil.which("tesseract") is not None,
+            "poppler": shutil.which("pdftoppm") is not None,
+        },
+        "prompt_variant": args.prompt_variant,
+        "ocr_context": args.ocr_context,
+        "live": args.live,
+        "mock": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "upload_latency": args.upload_latency,
+            "error_rate": args.error_rate,
+            "malformed_rate": args.malformed_rate,
+            "seed": args.seed,
+        },
+        "files": len(sample_files()),
+        "repeat": args.repeat,
+        "levels": levels,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bill extraction pipeline.")
+    parser.add_argument("--levels", type=lambda s: [int(x) for x in s.split(",")], default=[1, 4, 16],
+                        help="Comma-separated concurrency levels (default: 1,4,16).")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times each sample file is sent per level.")
+    parser.add_argument("--latency", type=float, default=0.8, help="Mean mock generate latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.3, help="Uniform +/- jitter on mock latencies.")
+    parser.add_argument("--upload-latency", type=float, default=0.2, help="Mean mock upload latency in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability a mock generate call fails.")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Probability a mock response is truncated JSON.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--prompt-variant", choices=sorted(extractor.PROMPTS), default=extractor.PROMPT_VARIANT)
+    parser.add_argument("--ocr-context", choices=["full", "trimmed"], default=ocr.OCR_CONTEXT_MODE)
+    parser.add_argument("--live", action="store_true", help="Call the real Gemini API instead of the stub.")
+    parser.add_argument("--reference", help="Results JSON of another run to compare item counts, totals and input tokens with.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before flagging a regression.")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--output", help="Also write the results to this JSON file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.reference:
+        with open(args.reference) as f:
+            accuracy = compare_accuracy(results, json.load(f))
+        print(f"Against {args.reference}: {accuracy['same_item_count']}/{accuracy['documents']} documents with the same "
+              f"item count, {accuracy['same_amount_total']}/{accuracy['documents']} with the same total; input tokens "
+              f"{accuracy['reference_input_tokens']} -> {accuracy['input_tokens']} ({accuracy['input_tokens_saved_pct']}% saved)")
+        return 0
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --save-baseline to create one.")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("mock") != results["mock"]:
+        print("Warning: mock settings differ from the baseline; the comparison may not be meaningful.")
+    if baseline.get("environment") != results["environment"]:
+        print("Warning: the baseline was taken on a different machine or setup; regenerate it with --save-baseline.")
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("Performance regressions against the baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "result_cache.db")
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def hash_bytes(data: bytes) -> str:
+    """
+    Returns the SHA-256 hex digest of the given bytes.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    with open(file_path, 'rb') as f:
+        return hash_bytes(f.read())
+
+
+def hash_source(source) -> str:
+    """
+    Returns the SHA-256 hex digest of in-memory bytes or of the file at a path.
+    """
+    return hash_bytes(source) if isinstance(source, bytes) else hash_file(source)
+
+
+def hash_page(page) -> str:
+    """
+    Returns a content hash for a single PyPDF2 page.
+    Covers the content stream and the embedded XObjects (scanned images), so the
+    same page hashes identically even when it appears inside a different PDF.
+    """
+    h = hashlib.sha256()
+    h.update(str(page.mediabox).encode())
+
+    contents = page.get("/Contents")
+    if contents is not None:
+        contents = contents.get_object()
+        streams = contents if isinstance(contents, list) else [contents]
+        for stream in streams:
+            h.update(stream.get_object().get_data())
+
+    resources = page.get("/Resources")
+    if resources is not None:
+        xobjects = resources.get_object().get("/XObject")
+        if xobjects is not None:
+            xobjects = xobjects.get_object()
+            for name in sorted(xobjects.keys()):
+                h.update(name.encode())
+                try:
+                    h.update(xobjects[name].get_object().get_data())
+                except Exception:
+                    h.update(repr(xobjects[name]).encode())
+
+    return h.hexdigest()
+
+
+def cache_key(content_hash: str, model_name: str, prompt_version: str, scope: str = "document") -> str:
+    """
+    Builds the cache key for a document or a single page.
+    A new model or prompt version never returns answers produced by the old one.
+    """
+    return f"{scope}:{model_name}:{prompt_version}:{content_hash}"
+
+
+class ResultCache:
+    """
+    SQLite-backed cache of extraction results.
+    Entries expire after `ttl_seconds`; once the stored payloads exceed `max_bytes`
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, ttl_seconds: int, max_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_accessed ON results (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(value)
+
+    def set(self, key: str, data):
+        value = json.dumps(data, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM results ORDER BY accessed_at ASC").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+
+
+result_cache = ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_BYTES) if RESULT_CACHE_ENABLED else None
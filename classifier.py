@@ -0,0 +1,137 @@
+import os
+import re
+import json
+
+import google.generativeai as genai
+
+from .planner import AMOUNT_RE, HEADER_RE, TOTAL_RE, guess_page_type
+from .ocr import trim_ocr_text
+from .scheduler import scheduler, estimate_prompt_tokens
+from .retry import call_with_retries
+from .instrumentation import span, increment
+
+CLASSIFIER_ENABLED = os.getenv("CLASSIFIER_ENABLED", "1") != "0"
+# Optional small model asked about pages the heuristics are unsure of; empty keeps them.
+CLASSIFIER_MODEL = os.getenv("CLASSIFIER_MODEL", "")
+CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", "0.8"))
+CLASSIFIER_MAX_CHARS = int(os.getenv("CLASSIFIER_MAX_CHARS", "600"))
+
+IRRELEVANT = "irrelevant"
+PAGE_TYPES = ("Bill Detail", "Final Bill", "Pharmacy", IRRELEVANT)
+
+BILLING_RE = re.compile(
+    r"\bbill\b|invoice|receipt|charges|\bgst\b|\bhsn\b|\brs\.?\b|\binr\b|₹|payable|\bpaid\b", re.IGNORECASE
+)
+IRRELEVANT_RE = re.compile(
+    r"discharge\s+summary|diagnosis|chief\s+complaints?|history\s+of|on\s+examination|treatment\s+given|"
+    r"advice\s+on\s+discharge|follow[\s-]?up|lab(?:oratory)?\s+report|investigation\s+report|test\s+name|"
+    r"reference\s+(?:range|interval)|biological\s+ref|specimen|sample\s+collected|mg/dl|g/dl|"
+    r"\bdear\b|to\s+whom\s+it\s+may\s+concern|yours\s+(?:faithfully|sincerely)|cover\s+letter|consent",
+    re.IGNORECASE,
+)
+ALNUM_RE = re.compile(r"[A-Za-z0-9]")
+
+CLASSIFIER_PROMPT = """Label each page of a hospital document by its OCR text.
+Labels: "Bill Detail" (itemized charges), "Final Bill" (bill summary/totals), "Pharmacy" (medicine bill), "irrelevant" (no billed line items: letters, discharge summaries, lab reports).
+Answer with minified JSON mapping page number to label, e.g. {"1":"Bill Detail","2":"irrelevant"}.
+"""
+
+
+def classify_page(text: str, source: str = "ocr") -> dict:
+    """
+    Labels one page from its OCR or text-layer text with a page type or "irrelevant",
+    using keywords and the number of lines that look like table rows with amounts.
+    Returns the label, a 0-1 confidence and the reason. Pages without readable text are
+    kept: skipping needs evidence.
+    """
+    if source == "ocr_failed" or len(ALNUM_RE.findall(text)) < 20:
+        return {"page_type": "Bill Detail", "confidence": 0.5, "reason": "no_text"}
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    amount_rows = sum(1 for line in lines if AMOUNT_RE.search(line))
+    billing = len(BILLING_RE.findall(text)) + len(HEADER_RE.findall(text)) + len(TOTAL_RE.findall(text))
+    irrelevant = len(IRRELEVANT_RE.findall(text))
+
+    if irrelevant and not billing and amount_rows == 0:
+        return {"page_type": IRRELEVANT, "confidence": 0.95, "reason": "non_billing_keywords"}
+    if irrelevant >= 3 and irrelevant > 2 * billing and amount_rows <= 2:
+        return {"page_type": IRRELEVANT, "confidence": 0.85, "reason": "mostly_non_billing_keywords"}
+    if irrelevant >= 2 and irrelevant > billing:
+        # Lab reports are full of numbers that look like amounts; let the model decide.
+        return {"page_type": IRRELEVANT, "confidence": 0.6, "reason": "mixed_keywords"}
+    if not billing and amount_rows == 0:
+        return {"page_type": IRRELEVANT, "confidence": 0.6, "reason": "no_amounts"}
+    confidence = 0.95 if amount_rows >= 2 and billing else 0.8
+    return {"page_type": guess_page_type(text), "confidence": confidence, "reason": "billing_content"}
+
+
+_model = None
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        _model = genai.GenerativeModel(
+            model_name=CLASSIFIER_MODEL,
+            generation_config={"temperature": 0.0, "max_output_tokens": 256, "response_mime_type": "application/json"},
+        )
+    return _model
+
+
+ZERO_USAGE = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+
+
+async def _classify_with_model(pages: dict[int, str]) -> tuple[dict[int, str], dict]:
+    """
+    Asks CLASSIFIER_MODEL for the labels of the given pages (page number -> text) in one
+    text-only call. Returns the labels it recognized and the token usage of the call.
+    """
+    prompt = CLASSIFIER_PROMPT + "".join(
+        f"\n--- Page {number} ---\n{trim_ocr_text(text, CLASSIFIER_MAX_CHARS)}" for number, text in pages.items()
+    )
+    estimated_tokens = estimate_prompt_tokens(prompt, num_pages=0)
+
+    async def attempt():
+        async with scheduler.slot(estimated_tokens=estimated_tokens):
+            with span("classify_model"):
+                response = await _get_model().generate_content_async(prompt)
+        usage = response.usage_metadata
+        scheduler.record_usage(estimated_tokens, usage.total_token_count)
+        increment("classifier_tokens", usage.total_token_count)
+        return json.loads(response.text), {
+            "total_tokens": usage.total_token_count,
+            "input_tokens": usage.prompt_token_count,
+            "output_tokens": usage.candidates_token_count,
+        }
+
+    labels, usage = await call_with_retries(attempt)
+    return {
+        int(number): label for number, label in labels.items()
+        if str(number).isdigit() and int(number) in pages and label in PAGE_TYPES
+    }, usage
+
+
+async def classify_pages(page_texts: list[str], text_sources: list[str]) -> tuple[list[dict], dict]:
+    """
+    Classifies every page of a document. Readable pages below CLASSIFIER_MIN_CONFIDENCE
+    are sent to CLASSIFIER_MODEL when one is configured; otherwise (or if that call
+    fails) they are kept for extraction. Returns the labels and the model's token usage.
+    """
+    usage = dict(ZERO_USAGE)
+    with span("classify"):
+        labels = [classify_page(text, source) for text, source in zip(page_texts, text_sources)]
+    unsure = {
+        i + 1: page_texts[i] for i, label in enumerate(labels)
+        if label["confidence"] < CLASSIFIER_MIN_CONFIDENCE and label["reason"] != "no_text"
+    }
+    if unsure and CLASSIFIER_MODEL:
+        try:
+            model_labels, usage = await _classify_with_model(unsure)
+            for number, page_type in model_labels.items():
+                labels[number - 1] = {"page_type": page_type, "confidence": CLASSIFIER_MIN_CONFIDENCE, "reason": "model"}
+        except Exception as e:
+            print(f"Page classification call failed; keeping uncertain pages: {e}")
+    for text, label in zip(page_texts, labels):
+        if label["page_type"] == IRRELEVANT and label["confidence"] < CLASSIFIER_MIN_CONFIDENCE:
+            label["page_type"] = guess_page_type(text)
+    return labels, usage
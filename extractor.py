@@ -1,15 +1,30 @@
 import os
-import json
 import google.generativeai as genai
 from dotenv import load_dotenv
-from .utils import download_file, cleanup_file
+from .utils import DocumentBuffer, download_document, slice_pdf, select_pdf_pages, debug_log
+from .cache import result_cache, cache_key, hash_bytes, hash_source, hash_page
+from .scheduler import (
+    scheduler, new_request_id, estimate_prompt_tokens, current_request_limit, GEMINI_PER_REQUEST_CONCURRENCY,
+)
+from .memory import memory_budget, rss_sampler, estimate_document_memory, Reservation
+from . import ocr
+from .ocr import ocr_pdf_pages, ocr_image, format_ocr_context, extract_text_layer
+from .preprocess import prepare_upload
+from .classifier import classify_pages, CLASSIFIER_ENABLED, IRRELEVANT
+from .backends import ExtractionBackend, LocalTableBackend, BackendRouter
+from .instrumentation import (
+    start_report, record, increment, span, observe_tokens,
+    RETRIES, JSON_REPAIRS, FALLBACKS, CACHE_HITS, PAGE_TEXT_SOURCES, UPLOAD_BYTES, PAGE_CLASSES, PAGE_BACKENDS,
+)
+from .planner import plan_chunks, guess_page_type
+from .uploads import upload_manager, UploadHandle
+from .parsing import OutputParser, OutputParseError, assign_pages, complete_page, page_number
+from .retry import call_with_retries
 import PyPDF2
 import io
 
 import asyncio
-from PIL import Image
-import pytesseract
-from pdf2image import convert_from_path
+from contextlib import nullcontext
 
 load_dotenv()
 
@@ -32,6 +47,11 @@ model = genai.GenerativeModel(
   generation_config=generation_config,
 )
 
+# Bump whenever PROMPT or COMPACT_PROMPT changes so cached results from the old prompt are not reused.
+PROMPT_VERSION = "1"
+
+ZERO_USAGE = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+
 PROMPT = """
 You are an expert data extraction assistant. Your task is to extract individual line item details from the provided bill/invoice document.
 
@@ -85,227 +105,613 @@ If a field is missing or not applicable, use null or 0 as appropriate.
 For `page_no`, if not explicitly marked, infer it (starting from 1).
 """
 
-def extract_ocr_text(file_path: str, mime_type: str) -> str:
+# Same rules as PROMPT in about a third of the tokens.
+COMPACT_PROMPT = """Extract every line item (product, medicine, service, charge) from the attached bill, grouped by page.
+- Skip subtotals, totals, previous balances and amount due. Keep taxes/discounts only if listed as their own line with an amount.
+- page_no: as printed, else count from 1. page_type: "Bill Detail", "Final Bill" or "Pharmacy".
+- Item row: [item_name exactly as printed, item_amount, item_rate or null, item_quantity or 1]. item_amount is the net line amount and must be a currency value, never a date, invoice number, phone number or ID.
+- Do not double count: item amounts must add up to the final bill total.
+- The OCR text below helps with handwriting; if it is garbled, trust the image and use rate * quantity = amount.
+OCR:
+{ocr_context}
+Answer with minified JSON only (no trailing commas; write 4.0 or 4, never "4."), shaped like:
+{"pagewise_line_items":[{"page_no":"1","page_type":"Bill Detail","bill_items":[["name",20.0,10.0,2]]}],"total_item_count":1}
+"""
+
+PROMPTS = {"full": PROMPT, "compact": COMPACT_PROMPT}
+PROMPT_VARIANT = os.getenv("PROMPT_VARIANT", "full")
+
+def _prompt() -> str:
+    return PROMPTS[PROMPT_VARIANT]
+
+def _prompt_version() -> str:
     """
-    Extracts text from the file using Tesseract OCR.
-    Handles Images directly. For PDFs, uses pdf2image to convert to images first.
+    Cache namespace of the prompt: results differ by prompt variant, OCR context mode,
+    whether irrelevant pages are skipped and how pages are routed to backends.
     """
-    ocr_text = ""
-    try:
-        if mime_type.startswith("image/"):
-            image = Image.open(file_path)
-            ocr_text = pytesseract.image_to_string(image)
-        elif mime_type == "application/pdf":
-            try:
+    classified = "-classified" if CLASSIFIER_ENABLED else ""
+    return f"{PROMPT_VERSION}-{PROMPT_VARIANT}-{ocr.OCR_CONTEXT_MODE}{classified}-{router.mode}"
 
-                images = convert_from_path(file_path)
-                for i, image in enumerate(images):
-                    text = pytesseract.image_to_string(image)
-                    ocr_text += f"\n[Page {i+1} OCR]: {text}\n"
-            except Exception as e:
-                print(f"PDF OCR failed (pdf2image): {e}")
-                ocr_text = f"OCR failed for PDF: {e}"
-            
-            if not ocr_text:
-                 ocr_text = "OCR not available for this PDF (Image extraction failed)."
+async def _extract_with_gemini(source, content_hash: str, mime_type: str, ocr_context: str):
+    """
+    Streams a Gemini extraction and returns (parsed, token_usage), where `parsed` is the
+    OutputParser result: completed pages, the recovered part of a truncated page, and
+    whether the JSON was complete. Only errors and output with no parsable page are retried.
+    """
+    # Upload the file once (or send it inline) and reuse it across retries
+    upload = await upload_manager.acquire(content_hash, source, mime_type)
+    try:
+        return await _generate(upload, source, mime_type, ocr_context)
+    finally:
+        upload_manager.release(upload)
 
-    except Exception as e:
-        print(f"OCR Failed: {e}")
-        ocr_text = f"OCR Failed: {e}"
-    
-    return ocr_text
+def _chunk_text(chunk) -> str:
+    try:
+        return chunk.text
+    except ValueError:
+        # Stream chunks without text parts (e.g. the final one carrying only metadata).
+        return ""
 
-async def _extract_with_gemini(file_path: str, mime_type: str):
-    # Upload the file
+async def _generate(upload: UploadHandle, source, mime_type: str, ocr_context: str):
 
-    file_ref = genai.upload_file(file_path, mime_type=mime_type)
+    label = f"{len(source)} bytes in memory" if isinstance(source, bytes) else source
+    debug_log.info(f"\n\n=== Processing {label} ===")
+    debug_log.info(f"OCR Context Length: {len(ocr_context)}")
+    debug_log.info(f"OCR Context Preview: {ocr_context[:200]}...")
     
+    formatted_prompt = _prompt().replace("{ocr_context}", ocr_context)
+    estimated_tokens = estimate_prompt_tokens(formatted_prompt)
+
+    async def attempt():
+        parser = OutputParser()
+        async with scheduler.slot(estimated_tokens=estimated_tokens):
+            with span("generate"):
+                response = await model.generate_content_async([formatted_prompt, upload.part], stream=True)
+                async for chunk in response:
+                    parser.feed(_chunk_text(chunk))
+        scheduler.record_usage(estimated_tokens, response.usage_metadata.total_token_count)
+        
+        debug_log.info(f"LLM Response Raw:\n{parser.text}")
+
+        with span("json_parse"):
+            try:
+                parsed = parser.finish()
+            except OutputParseError as e:
+                print(e)
+                JSON_REPAIRS.labels("failed").inc()
+                raise
+        if not parsed["complete"]:
+            print(f"Model output was truncated; recovered {len(parsed['pages'])} complete page(s).")
+            JSON_REPAIRS.labels("partial").inc()
+            increment("json_repairs")
+        if parser.rows_rejected:
+            increment("rows_rejected", parser.rows_rejected)
+
+        usage = response.usage_metadata
+        token_usage = {
+            "total_tokens": usage.total_token_count,
+            "input_tokens": usage.prompt_token_count,
+            "output_tokens": usage.candidates_token_count
+        }
+
+        return parsed, token_usage
+
+    async def on_retry(error, kind):
+        debug_log.exception(f"Exception in _extract_with_gemini ({kind}): {error}")
+        if not isinstance(upload.part, dict) and upload.part.name in str(error):
+            # The uploaded file expired or was deleted; upload it again.
+            await upload_manager.renew(upload, source, mime_type)
+
+    # Generate content with backoff, the global retry budget and the circuit breaker
+    return await call_with_retries(attempt, on_retry=on_retry)
+
+def _to_data(pages: list[dict]) -> dict:
+    return {
+        "pagewise_line_items": pages,
+        "total_item_count": sum(len(page.get("bill_items", [])) for page in pages),
+    }
 
-    loop = asyncio.get_running_loop()
-    ocr_context = await loop.run_in_executor(None, extract_ocr_text, file_path, mime_type)
-    
-    with open("debug_log.txt", "a", encoding="utf-8") as f:
-        f.write(f"\n\n=== Processing {file_path} ===\n")
-        f.write(f"OCR Context Length: {len(ocr_context)}\n")
-        f.write(f"OCR Context Preview: {ocr_context[:200]}...\n")
-    
-    formatted_prompt = PROMPT.replace("{ocr_context}", ocr_context)
+def _add_usage(total: dict, usage: dict):
+    for key in total:
+        total[key] += usage[key]
+
+def _missing_pages_pdf(source, page_indices: list[int]) -> bytes:
+    reader = PyPDF2.PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+    return select_pdf_pages(reader, page_indices)
 
-    # Generate content with retry logic
-    max_retries = 3
-    for attempt in range(max_retries):
+async def _extract_assigned(source, content_hash: str, mime_type: str, page_texts: list[str], first_page: int):
+    """
+    Extracts the pages of a PDF (or chunk of one) whose document page numbers start at
+    `first_page`. When the output was cut off, the pages missing from it, including the
+    one it was cut off in, are re-requested once on their own instead of repeating the
+    whole call; if that fails, the recovered rows of the truncated page are kept. Pages
+    left out of a complete output have no line items and are returned empty.
+    Returns ({page number: page}, token_usage, number of the truncated page or None).
+    """
+    ocr_context = format_ocr_context(page_texts, first_page=first_page)
+    parsed, usage = await _extract_with_gemini(source, content_hash, mime_type, ocr_context)
+    partial = parsed["partial_page"]
+    expected = list(range(first_page, first_page + len(page_texts)))
+    page_types = [guess_page_type(text) for text in page_texts]
+    assigned = assign_pages(parsed["pages"], expected, page_types)
+    missing = [n for n in expected if n not in assigned]
+    if missing and parsed["complete"]:
+        # e.g. a totals-only Final Bill page the model had nothing to list for.
+        for n in missing:
+            assigned[n] = complete_page({}, n, page_types[n - first_page])
+        missing = []
+    if missing:
+        print(f"Re-requesting {len(missing)} page(s) missing from the model output: {missing}")
+        RETRIES.labels("missing_pages").inc()
+        increment("page_rerequests", len(missing))
         try:
+            indices = [n - first_page for n in missing]
+            sub_source = await asyncio.to_thread(_missing_pages_pdf, source, indices)
+            context = "".join(format_ocr_context([page_texts[i]], first_page=n) for i, n in zip(indices, missing))
+            retried, retry_usage = await _extract_with_gemini(sub_source, hash_bytes(sub_source), mime_type, context)
+            _add_usage(usage, retry_usage)
+            missing_types = [page_types[i] for i in indices]
+            for number, page in assign_pages(retried["pages"], missing, missing_types).items():
+                assigned[number] = page
+            partial = retried["partial_page"] or partial
+            missing = [n for n in missing if n not in assigned]
+        except Exception as e:
+            print(f"Re-request of missing pages failed: {e}")
 
-            response = await model.generate_content_async([formatted_prompt, file_ref])
-            
+    truncated = None
+    if partial is not None and missing:
+        truncated = missing[0]
+        assigned.setdefault(truncated, complete_page(partial, truncated, page_types[truncated - first_page]))
+    return assigned, usage, truncated
 
-            text = response.text
-            
-            with open("debug_log.txt", "a", encoding="utf-8") as f:
-                f.write(f"LLM Response Raw (Attempt {attempt+1}):\n{text}\n")
-            
+def _unplaced_pages(parsed: dict, page_type: str) -> list[dict]:
+    """
+    The pages of a result without known page numbers (an image, or a PDF whose pages could
+    not be read), numbered as the model did or in order, with missing fields filled in.
+    """
+    pages = parsed["pages"] + ([parsed["partial_page"]] if parsed["partial_page"] else [])
+    return [complete_page(page, page_number(page) or i + 1, page_type) for i, page in enumerate(pages)]
 
-            if text.startswith("```json"):
-                text = text[7:]
-            if text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            text = text.strip()
-            
+async def _extract_pages(source, content_hash: str, mime_type: str, page_texts: list[str], first_page: int = 1):
+    """
+    Extracts the pages of a PDF (or chunk of one) as one result; see _extract_assigned.
+    """
+    if not page_texts:
+        ocr_context = format_ocr_context(page_texts, first_page=first_page)
+        parsed, usage = await _extract_with_gemini(source, content_hash, mime_type, ocr_context)
+        return _to_data(_unplaced_pages(parsed, "Bill Detail")), usage
+    assigned, usage, _ = await _extract_assigned(source, content_hash, mime_type, page_texts, first_page)
+    return _to_data([assigned[n] for n in sorted(assigned)]), usage
+
+async def _cache_get(content_hash: str, scope: str):
+    if result_cache is None:
+        return None
+    return await asyncio.to_thread(result_cache.get, cache_key(content_hash, model.model_name, _prompt_version(), scope))
+
+async def _cache_set(content_hash: str, scope: str, data):
+    if result_cache is None:
+        return
+    await asyncio.to_thread(result_cache.set, cache_key(content_hash, model.model_name, _prompt_version(), scope), data)
+
+def _missed_runs(cached: list) -> list[tuple[int, int]]:
+    """
+    Returns the [start, end) runs of consecutive pages without a cached result.
+    """
+    runs = []
+    for i, page in enumerate(cached):
+        if page is not None:
+            continue
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+    return runs
+
+async def _extract_chunk_cached(load_pages, page_hashes: list[str], mime_type: str, page_texts: list[str],
+                                first_page: int):
+    """
+    Extracts a chunk page by page through the page-level cache: every page is cached under
+    its own content hash, so a page seen before in any chunk of any document is not sent
+    again. Only runs of missed pages are extracted; `load_pages(start, end)` returns the PDF
+    bytes of chunk pages [start, end) and is awaited only for those. A page the output was
+    cut off in is returned but not cached.
+    """
+    cached = await asyncio.gather(*(_cache_get(page_hash, "page") for page_hash in page_hashes))
+    hits = sum(1 for page in cached if page is not None)
+    if hits:
+        CACHE_HITS.labels("page").inc(hits)
+        increment("page_cache_hits", hits)
+    pages = {first_page + i: page for i, page in enumerate(cached) if page is not None}
+
+    usage = dict(ZERO_USAGE)
+    for start, end in _missed_runs(cached):
+        run_data = await load_pages(start, end)
+        run_hash = hash_bytes("".join(page_hashes[start:end]).encode())
+        assigned, run_usage, truncated = await _extract_assigned(
+            run_data, run_hash, mime_type, page_texts[start:end], first_page + start
+        )
+        _add_usage(usage, run_usage)
+        for number, page in assigned.items():
+            pages[number] = page
+            if number != truncated:
+                await _cache_set(page_hashes[number - first_page], "page", page)
+
+    for number, page in pages.items():
+        # A cached page may come from another position or document.
+        page["page_no"] = str(number)
+    return _to_data([pages[n] for n in sorted(pages)]), usage
+
+class GeminiBackend(ExtractionBackend):
+    """
+    The Gemini extraction path, with the page-level cache. Handles any page.
+    """
 
-            
-            try:
-                extracted_data = json.loads(text)
-            except json.JSONDecodeError:
+    name = "gemini"
 
-                print("JSON parse failed, attempting repair...")
-                text_repaired = text.replace("}}", "}")
-                try:
-                     extracted_data = json.loads(text_repaired)
-                     print("JSON repair successful.")
-                except:
-
-                    if text.strip().endswith("}}"):
-                        text_repaired = text.strip()[:-2] + "}"
-                        extracted_data = json.loads(text_repaired)
-                    else:
-                        raise
-            
+    def confidence(self, text: str, source: str) -> float:
+        return 1.0
 
-            if "pagewise_line_items" in extracted_data:
-                for page in extracted_data["pagewise_line_items"]:
-                    if "bill_items" in page and isinstance(page["bill_items"], list):
-                        new_items = []
-                        for item in page["bill_items"]:
-                            if isinstance(item, list) and len(item) >= 4:
-                                new_items.append({
-                                    "item_name": item[0],
-                                    "item_amount": item[1],
-                                    "item_rate": item[2],
-                                    "item_quantity": item[3]
-                                })
-                            elif isinstance(item, dict):
-                                new_items.append(item)
-                        page["bill_items"] = new_items
-            
+    async def extract(self, load_pages, page_hashes, mime_type, page_texts, first_page):
+        return await _extract_chunk_cached(load_pages, page_hashes, mime_type, page_texts, first_page)
 
-            usage = response.usage_metadata
-            token_usage = {
-                "total_tokens": usage.total_token_count,
-                "input_tokens": usage.prompt_token_count,
-                "output_tokens": usage.candidates_token_count
-            }
+# Cheapest backend first; Gemini takes every page the local engine is not sure of.
+router = BackendRouter([LocalTableBackend(), GeminiBackend()])
 
-            return extracted_data, token_usage
-            
-        except json.JSONDecodeError:
-            error_msg = f"Failed to parse LLM response as JSON. Length: {len(text)}. Start: {text[:200]}... End: ...{text[-200:]}"
-            print(error_msg)
-            if attempt == max_retries - 1:
-                raise Exception(error_msg)
-            print(f"JSON parse failed, retrying ({attempt + 1}/{max_retries})...")
-            continue
-        except Exception as e:
-            import traceback
-            with open("debug_log.txt", "a", encoding="utf-8") as f:
-                f.write(f"Exception in _extract_with_gemini: {e}\n")
-                f.write(traceback.format_exc() + "\n")
-            
-            if attempt == max_retries - 1:
-                raise e
-            print(f"Generation failed: {e}, retrying ({attempt + 1}/{max_retries})...")
-            continue
+def _route_pages(page_texts: list[str], text_sources: list[str], skip: set[int]) -> list[str]:
+    """
+    Chooses the backend of every page that is not skipped (None for skipped pages).
+    """
+    backends = router.route(page_texts, text_sources)
+    backends = [None if i in skip else name for i, name in enumerate(backends)]
+    for name in backends:
+        if name is not None:
+            PAGE_BACKENDS.labels(name).inc()
+    record("page_backends", backends)
+    return backends
+
+def _read_pdf_pages(stream):
+    """
+    Parses the PDF once and returns the reader with the content hash and embedded text
+    layer of every page. The reader keeps reading from `stream`, so it must stay open.
+    """
+    reader = PyPDF2.PdfReader(stream)
+    pages = reader.pages
+    return reader, [hash_page(page) for page in pages], [extract_text_layer(page) for page in pages]
 
-async def process_document(url: str):
+async def _prepare_image_upload(document: DocumentBuffer):
     """
-    Downloads the document, sends it to Gemini for extraction, and returns the structured data and token usage.
-    Handles large PDFs by splitting them into chunks and processing in parallel.
+    Returns (source, mime_type) of the downscaled, recompressed copy of an image that is
+    uploaded to Gemini. Runs in the OCR worker pool.
     """
-    file_path = download_file(url)
-    try:
-        mime_type = "application/pdf" if file_path.endswith(".pdf") else "image/jpeg"
-        if file_path.endswith(".png"): mime_type = "image/png"
+    with span("preprocess"):
+        source, mime_type = await ocr.run_in_pool(prepare_upload, document.source, document.mime_type)
+    size = len(source) if isinstance(source, bytes) else document.size
+    UPLOAD_BYTES.labels("original").inc(document.size)
+    UPLOAD_BYTES.labels("uploaded").inc(size)
+    record("upload_bytes", {"original": document.size, "uploaded": size})
+    return source, mime_type
+
+async def _skipped_pages(page_texts: list[str], text_sources: list[str]) -> tuple[set[int], dict]:
+    """
+    Pre-classifies the pages of a multi-page PDF and returns the 0-based indices of pages
+    without billing content, which are not sent for extraction, and the token usage of
+    the classification. If no page looks like a bill, nothing is skipped.
+    """
+    if not CLASSIFIER_ENABLED or len(page_texts) < 2:
+        return set(), dict(ZERO_USAGE)
+    labels, usage = await classify_pages(page_texts, text_sources)
+    for label in labels:
+        PAGE_CLASSES.labels(label["page_type"]).inc()
+    record("page_types", [label["page_type"] for label in labels])
+    skip = {i for i, label in enumerate(labels) if label["page_type"] == IRRELEVANT}
+    if len(skip) == len(labels):
+        print("No billing pages recognized; extracting all pages.")
+        return set(), usage
+    record("skipped_pages", [{"page_no": str(i + 1), "reason": labels[i]["reason"]} for i in sorted(skip)])
+    increment("pages_skipped", len(skip))
+    return skip, usage
+
+async def _indexed(index: int, coro):
+    data, usage = await coro
+    return index, data, usage
+
+# Chunk index of the event _iter_chunks yields once the chunk plan of a PDF is fixed.
+PLANNED = "planned"
+
+async def _iter_chunks(document: DocumentBuffer, doc_hash: str, completed_chunks: set, plan: list[dict] | None = None):
+    """
+    Async generator yielding (chunk_index, data, token_usage) as each chunk finishes.
+    Chunks complete out of order; the index is their position in the chunk plan.
+    For PDFs, (PLANNED, plan, token_usage) is yielded first, so the plan can be stored;
+    the usage is that of planning (page classification).
+
+    Chunks listed in `completed_chunks` (checkpointed by an earlier run) are skipped.
+    A resumed run must pass the `plan` of the earlier run, since its chunk indices refer
+    to it; such a run fails instead of falling back to single file processing.
+    """
+    mime_type = document.mime_type
 
 
-        if mime_type == "application/pdf":
-            try:
-                with open(file_path, 'rb') as f:
-                    reader = PyPDF2.PdfReader(f)
-                    num_pages = len(reader.pages)
+    if mime_type == "application/pdf":
+        page_texts, page_hashes = [], []
+        emitted = False
+        planning_usage = dict(ZERO_USAGE)
+        stream = document.open()
+        try:
+            with span("pdf_parse"):
+                reader, page_hashes, text_layers = await asyncio.to_thread(_read_pdf_pages, stream)
+            num_pages = len(page_hashes)
+            
+            # Digital pages use their text layer; the rest are rasterized and OCR'd
+            # exactly once, however they are chunked below.
+            with span("ocr"):
+                page_texts, text_sources = await ocr_pdf_pages(document.source, page_hashes, text_layers, reader=reader)
+            record("page_text_sources", text_sources)
+            for source in text_sources:
+                PAGE_TEXT_SOURCES.labels(source).inc()
+            
+            if plan is None:
+                skip, planning_usage = await _skipped_pages(page_texts, text_sources)
+                backends = _route_pages(page_texts, text_sources, skip)
+                routed = {i for i, name in enumerate(backends) if name not in (None, GeminiBackend.name)}
+                with span("plan"):
+                    plan = plan_chunks(page_texts, estimate_prompt_tokens(_prompt(), num_pages=0), skip=skip | routed)
+                # Pages routed to another backend are extracted on their own, in document order.
+                plan = sorted(
+                    [dict(chunk, backend=GeminiBackend.name) for chunk in plan]
+                    + [{"start": i, "end": i + 1, "backend": backends[i], "reason": "routed"} for i in sorted(routed)],
+                    key=lambda chunk: chunk["start"],
+                )
+            elif any(chunk["end"] > num_pages for chunk in plan):
+                raise ValueError("The document no longer matches the stored chunk plan.")
+            record("chunk_plan", plan)
+            yield PLANNED, plan, planning_usage
+            planning_usage = dict(ZERO_USAGE)
+
+            whole_document = (len(plan) == 1 and plan[0]["start"] == 0 and plan[0]["end"] == num_pages
+                              and plan[0].get("backend", GeminiBackend.name) == GeminiBackend.name)
+            if not whole_document:
+                print(f"Large PDF detected ({num_pages} pages). Processing in {len(plan)} chunks...")
                 
-                if num_pages > 2:
-                    print(f"Large PDF detected ({num_pages} pages). Processing in chunks...")
-                    
-                    chunk_size = 1
-                    all_pages_data = []
-                    total_usage = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
-                    
-                    chunk_files = []
-                    
-                    with open(file_path, 'rb') as f:
-                        reader = PyPDF2.PdfReader(f)
-                        
-                        for i in range(0, num_pages, chunk_size):
-                            chunk_writer = PyPDF2.PdfWriter()
-                            end_page = min(i + chunk_size, num_pages)
-                            for page_num in range(i, end_page):
-                                chunk_writer.add_page(reader.pages[page_num])
-                            
+                # Chunk PDFs are cut only when their extraction starts, so a request holds at
+                # most its concurrency limit of them in memory, not a copy of the whole document.
+                split_lock = asyncio.Lock()
+                in_flight = asyncio.Semaphore(current_request_limit.get() or GEMINI_PER_REQUEST_CONCURRENCY)
+                tasks = []
+
+                async def run_chunk(index: int, backend: ExtractionBackend, start: int, end: int):
+                    async def load_pages(first: int, last: int):
+                        async with split_lock:
+                            with span("split"):
+                                return await asyncio.to_thread(slice_pdf, reader, start + first, start + last)
+
+                    async with in_flight:
+                        return await _indexed(index, backend.extract(
+                            load_pages, page_hashes[start:end], mime_type, page_texts[start:end], start + 1
+                        ))
+                
+                try:
 
-                            import tempfile
-                            fd, chunk_path = tempfile.mkstemp(suffix=".pdf")
-                            os.close(fd)
-                            
-                            with open(chunk_path, 'wb') as out_f:
-                                chunk_writer.write(out_f)
-                            
-                            chunk_files.append(chunk_path)
+                    for index, chunk in enumerate(plan):
+                        if index in completed_chunks:
+                            continue
+                        backend = router.get(chunk.get("backend", GeminiBackend.name))
+                        tasks.append(asyncio.ensure_future(run_chunk(index, backend, chunk["start"], chunk["end"])))
                     
-                    try:
-
-                        tasks = [_extract_with_gemini(cp, mime_type) for cp in chunk_files]
-                        results = await asyncio.gather(*tasks)
-                        
-                        for i, (data, usage) in enumerate(results):
-                            print(f"Processed chunk {i+1}")
-                            if data and "pagewise_line_items" in data:
-                                all_pages_data.extend(data["pagewise_line_items"])
+                    for next_done in asyncio.as_completed(tasks):
+                        index, data, usage = await next_done
+                        print(f"Processed chunk {index+1}")
+                        observe_tokens(usage, plan[index]["end"] - plan[index]["start"])
+                        emitted = True
+                        yield index, data, usage
                             
-                            if usage:
-                                total_usage["total_tokens"] += usage["total_tokens"]
-                                total_usage["input_tokens"] += usage["input_tokens"]
-                                total_usage["output_tokens"] += usage["output_tokens"]
-                                
-                    finally:
-                        for cp in chunk_files:
-                            if os.path.exists(cp):
-                                os.remove(cp)
-                    
-
-                    final_data = {
-                        "pagewise_line_items": all_pages_data,
-                        "total_item_count": sum(len(p.get("bill_items", [])) for p in all_pages_data)
-                    }
-                    return final_data, total_usage
-
-            except Exception as e:
-                print(f"Error processing PDF chunks: {e}. Falling back to single file processing.")
-
-
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                return
 
-        return await _extract_with_gemini(file_path, mime_type)
+        except Exception as e:
+            # Pages already streamed to the caller cannot be taken back, and the chunks
+            # checkpointed by an earlier run do not correspond to a single-file result.
+            if emitted or completed_chunks:
+                raise
+            print(f"Error processing PDF chunks: {e}. Falling back to single file processing.")
+            FALLBACKS.inc()
+            increment("fallbacks")
+            plan = [{"start": 0, "end": len(page_texts), "backend": GeminiBackend.name, "reason": "fallback"}]
+            record("chunk_plan", plan)
+            yield PLANNED, plan, planning_usage
+        finally:
+            stream.close()
+
+        # The plan is a single chunk covering the whole document.
+        if 0 in completed_chunks:
+            return
+        if page_hashes:
+            async def load_pages(start: int, end: int):
+                if (start, end) == (0, len(page_hashes)):
+                    return document.source
+                with span("split"):
+                    return await asyncio.to_thread(_missing_pages_pdf, document.source, list(range(start, end)))
+
+            data, usage = await router.get(GeminiBackend.name).extract(load_pages, page_hashes, mime_type, page_texts, 1)
+        else:
+            data, usage = await _extract_pages(document.source, doc_hash, mime_type, page_texts)
+        observe_tokens(usage, len(page_texts))
+        yield 0, data, usage
+        return
+
+
+    if 0 in completed_chunks:
+        return
+    # The OCR copy (grayscale/binarized) and the upload copy are prepared in parallel.
+    async def ocr_text():
+        with span("ocr"):
+            return await ocr_image(document.source, doc_hash, mime_type)
+
+    text, (upload_source, upload_mime) = await asyncio.gather(ocr_text(), _prepare_image_upload(document))
+    record("page_text_sources", ["ocr"])
+    PAGE_TEXT_SOURCES.labels("ocr").inc()
+    backend = router.get(_route_pages([text], ["ocr"], set())[0])
+    if backend.name != GeminiBackend.name:
+        data, usage = await backend.extract(None, [doc_hash], mime_type, [text], 1)
+        yield 0, data, usage
+        return
+    ocr_context = ocr.context_text(text)
+    parsed, usage = await _extract_with_gemini(upload_source, doc_hash, upload_mime, ocr_context)
+    data = _to_data(_unplaced_pages(parsed, guess_page_type(text)))
+    observe_tokens(usage, 1)
+    yield 0, data, usage
+
+async def iter_file(document: DocumentBuffer, doc_hash: str | None = None, completed_chunks: set | None = None,
+                    report: dict | None = None, plan: list[dict] | None = None, reservation: Reservation | None = None):
+    """
+    Yields extraction events for an already downloaded document as soon as they are available:
+    a `planned` progress event with the chunk plan (PDFs), one `page` event per extracted
+    page (tagged with its chunk index), a `chunk_done` progress event per chunk, and a
+    final `summary` event with total_item_count, token_usage and metadata. Only the page
+    results needed for the document cache are kept in memory. The caller owns the
+    document and the scheduling scope (new_request_id).
+
+    `completed_chunks` resumes an interrupted run: those chunk indices of the earlier
+    run's `plan` are not extracted again and the summary only covers the chunks processed
+    by this call.
+    `report` continues an instrumentation report started by the caller.
+    `reservation` is the memory the caller reserved for the document before downloading
+    it; it is resized to the document's estimate (released on a cache hit) instead of
+    admitting the document again.
+    """
+    completed_chunks = completed_chunks or set()
+    metadata = report if report is not None else start_report()
+    try:
+        if doc_hash is None:
+            with span("hash"):
+                doc_hash = await asyncio.to_thread(hash_source, document.source)
+
+        with span("cache_lookup"):
+            cached = await _cache_get(doc_hash, "document") if not completed_chunks else None
+        if cached is not None:
+            if reservation is not None:
+                await reservation.release()
+            print(f"Result cache hit for document {doc_hash[:12]}.")
+            record("cache", "document")
+            CACHE_HITS.labels("document").inc()
+            for page in cached.get("pagewise_line_items", []):
+                yield {"event": "page", "chunk": 0, "page": page}
+            # The whole cached result counts as one finished chunk, so it can be checkpointed.
+            yield {"event": "progress", "stage": "chunk_done", "chunk": 0, "token_usage": dict(ZERO_USAGE),
+                   "chunks_done": 1, "chunks_total": 1}
+            yield {"event": "summary", "total_item_count": cached.get("total_item_count", 0),
+                   "token_usage": dict(ZERO_USAGE), "metadata": metadata}
+            return
+
+        total_usage = dict(ZERO_USAGE)
+        item_count = 0
+        chunks_done = 0
+        collected = {} if result_cache is not None and not completed_chunks else None
+
+        # Admission waits while the memory budget is spent; the peak RSS is reported.
+        memory_needed = estimate_document_memory(document.size, isinstance(document.source, bytes))
+        if reservation is not None:
+            await reservation.resize(memory_needed)
+        admission = memory_budget.admit(memory_needed) if reservation is None else nullcontext()
+        async with rss_sampler.track(), admission:
+            async for index, data, usage in _iter_chunks(document, doc_hash, completed_chunks, plan):
+                if index == PLANNED:
+                    _add_usage(total_usage, usage)
+                    yield {"event": "progress", "stage": "planned", "chunk_plan": data, "chunks_total": len(data),
+                           "token_usage": usage}
+                    continue
+                pages = data.get("pagewise_line_items", []) if data else []
+                for page in pages:
+                    item_count += len(page.get("bill_items", []))
+                    yield {"event": "page", "chunk": index, "page": page}
+                if collected is not None:
+                    collected[index] = pages
+
+                if usage:
+                    total_usage["total_tokens"] += usage["total_tokens"]
+                    total_usage["input_tokens"] += usage["input_tokens"]
+                    total_usage["output_tokens"] += usage["output_tokens"]
+
+                chunks_done += 1
+                yield {"event": "progress", "stage": "chunk_done", "chunk": index, "token_usage": usage or dict(ZERO_USAGE),
+                       "chunks_done": chunks_done + len(completed_chunks),
+                       "chunks_total": len(metadata.get("chunk_plan") or [None])}
+
+        if collected is not None:
+            await _cache_set(doc_hash, "document", {
+                "pagewise_line_items": [p for i in sorted(collected) for p in collected[i]],
+                "total_item_count": item_count
+            })
+
+        yield {"event": "summary", "total_item_count": item_count, "token_usage": total_usage, "metadata": metadata}
 
     except Exception as e:
         print(f"Error in process_document: {e}")
 
         if "404" in str(e) or "not found" in str(e).lower():
              print("Model not found. Listing available models...")
-             for m in genai.list_models():
+             for m in await asyncio.to_thread(list, genai.list_models()):
                  if 'generateContent' in m.supported_generation_methods:
                      print(m.name)
         raise e
 
+async def iter_document(url: str, completed_chunks: set | None = None, plan: list[dict] | None = None):
+    """
+    Downloads the document into memory and yields its extraction events (see iter_file),
+    preceded by a `downloaded` progress event. Each call is its own scheduling scope.
+    The document is admitted to the memory budget before its body is read.
+    """
+    new_request_id()
+    report = start_report()
+    reservation = None
+
+    async def reserve(content_length: int | None):
+        nonlocal reservation
+        reservation = await memory_budget.reserve(estimate_document_memory(content_length))
+
+    document = None
+    try:
+        with span("download"):
+            async with rss_sampler.track():
+                document = await download_document(url, on_headers=reserve)
+        yield {"event": "progress", "stage": "downloaded"}
+        async for event in iter_file(document, completed_chunks=completed_chunks, report=report, plan=plan,
+                                     reservation=reservation):
+            yield event
     finally:
-        cleanup_file(file_path)
- 
+        if document is not None:
+            document.close()
+        if reservation is not None:
+            await reservation.release()
+
+async def collect_events(events):
+    """
+    Consumes an event stream from iter_document/iter_file and returns (data, token_usage, metadata),
+    with pages restored to document order.
+    """
+    pages_by_chunk = {}
+    summary = None
+    async for event in events:
+        if event["event"] == "page":
+            pages_by_chunk.setdefault(event["chunk"], []).append(event["page"])
+        elif event["event"] == "summary":
+            summary = event
+
+    final_data = {
+        "pagewise_line_items": [p for i in sorted(pages_by_chunk) for p in pages_by_chunk[i]],
+        "total_item_count": summary["total_item_count"]
+    }
+    return final_data, summary["token_usage"], summary["metadata"]
+
+async def process_document(url: str):
+    """
+    Downloads the document, sends it to Gemini for extraction, and returns the structured data and token usage.
+    Handles large PDFs by splitting them into chunks (sized by the batching planner) and processing in parallel.
+    Results are cached by the SHA-256 of the document (and of each page), so repeated
+    documents come back without any Gemini call and with zero token usage.
+    Gemini calls go through the shared scheduler, which caps concurrency per request and globally.
+    Returns (data, token_usage, metadata), where metadata is the request's instrumentation report.
+    """
+    return await collect_events(iter_document(url))
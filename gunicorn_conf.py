@@ -0,0 +1,77 @@
+"""
+Gunicorn config for running the API with several worker processes.
+
+Usage (from the directory containing bill_extractor/):
+    gunicorn -c bill_extractor/gunicorn_conf.py bill_extractor.main:app
+
+The master starts one dedicated OCR server (OCR_WORKERS processes) that all web
+workers share, and points every worker at the same SQLite files, so the result cache,
+Gemini RPM/TPM buckets and job store are shared across processes. Prometheus metrics
+of all workers are aggregated through PROMETHEUS_MULTIPROC_DIR.
+
+The master never imports the bill_extractor package: that would start its background
+threads (the debug log writer) before the workers fork, and forked workers do not
+inherit threads.
+"""
+import os
+import sys
+import time
+import socket
+import secrets
+import tempfile
+import subprocess
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("WEB_TIMEOUT", "300"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+
+# Set before the workers are forked, so every worker reads the same shared-state settings.
+os.environ.setdefault("SHARED_STATE_PATH", "shared_state.db")
+os.environ.setdefault("OCR_SERVER_ADDRESS", "127.0.0.1:50055")
+# A fresh secret per deployment; the OCR server unpickles what its clients send.
+os.environ.setdefault("OCR_SERVER_AUTHKEY", secrets.token_hex(32))
+# Must be set before prometheus_client is imported in the workers, and start empty.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="bill-extractor-metrics-"))
+
+OCR_SERVER_START_TIMEOUT = float(os.getenv("OCR_SERVER_START_TIMEOUT", "30"))
+
+_ocr_server = None
+
+
+def _wait_for_ocr_server(address: str):
+    host, _, port = address.rpartition(":")
+    deadline = time.monotonic() + OCR_SERVER_START_TIMEOUT
+    while time.monotonic() < deadline and _ocr_server.poll() is None:
+        try:
+            if host and port.isdigit():
+                socket.create_connection((host, int(port)), timeout=1).close()
+                return
+            if os.path.exists(address):
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"OCR server did not start listening on {address}.")
+
+
+def on_starting(server):
+    global _ocr_server
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    _ocr_server = subprocess.Popen([sys.executable, "-m", "bill_extractor.ocr_server"], env=os.environ.copy())
+    _wait_for_ocr_server(os.environ["OCR_SERVER_ADDRESS"])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if _ocr_server is not None and _ocr_server.poll() is None:
+        _ocr_server.terminate()
+        try:
+            _ocr_server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _ocr_server.kill()
@@ -0,0 +1,107 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+current_report = contextvars.ContextVar("current_report", default=None)
+
+STAGE_SECONDS = Histogram(
+    "bill_extractor_stage_seconds",
+    "Time spent in each stage of the extraction pipeline.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160),
+)
+TOKENS_PER_PAGE = Histogram(
+    "bill_extractor_tokens_per_page",
+    "Gemini tokens spent per extracted page.",
+    ["kind"],
+    buckets=(0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+STAGE_CPU_SECONDS = Counter(
+    "bill_extractor_stage_cpu_seconds_total",
+    "Process CPU time (user + system) elapsed while each stage ran.",
+    ["stage"],
+)
+RETRIES = Counter("bill_extractor_retries_total", "Gemini generation retries.", ["reason"])
+JSON_REPAIRS = Counter("bill_extractor_json_repairs_total", "Model responses that needed JSON repair.", ["outcome"])
+FALLBACKS = Counter("bill_extractor_fallbacks_total", "Chunked PDFs that fell back to single-file processing.")
+CACHE_HITS = Counter("bill_extractor_cache_hits_total", "Result cache hits.", ["scope"])
+PAGE_TEXT_SOURCES = Counter("bill_extractor_page_text_sources_total", "How page text was obtained.", ["source"])
+UPLOADS = Counter("bill_extractor_uploads_total", "Gemini file parts by outcome.", ["outcome"])
+RETRY_BUDGET_EXHAUSTED = Counter("bill_extractor_retry_budget_exhausted_total", "Retries skipped because the global retry budget was spent.")
+BREAKER_STATE = Gauge("bill_extractor_breaker_state", "Gemini circuit breaker state (0 closed, 1 half-open, 2 open).",
+                      multiprocess_mode="max")
+BREAKER_REJECTIONS = Counter("bill_extractor_breaker_rejections_total", "Calls failed fast by the open circuit breaker.")
+UPLOAD_BYTES = Counter("bill_extractor_image_upload_bytes_total", "Image bytes before and after preprocessing.", ["stage"])
+PAGE_CLASSES = Counter("bill_extractor_page_classes_total", "Pages by pre-classification label.", ["page_type"])
+PAGE_BACKENDS = Counter("bill_extractor_page_backends_total", "Pages by extraction backend.", ["backend"])
+MEMORY_RESERVED = Gauge("bill_extractor_memory_reserved_bytes", "Memory reserved by admitted documents.",
+                        multiprocess_mode="livesum")
+ADMISSION_REJECTIONS = Counter("bill_extractor_admission_rejections_total", "Documents rejected by the memory budget.", ["reason"])
+PEAK_RSS = Histogram(
+    "bill_extractor_request_peak_rss_mb",
+    "Peak process RSS observed during a request, in MB.",
+    buckets=(128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096, 8192),
+)
+
+
+def start_report() -> dict:
+    """
+    Starts the per-request instrumentation report. Tasks spawned afterwards share
+    the same dict, so any stage of the pipeline can record into it.
+    """
+    report = {}
+    current_report.set(report)
+    return report
+
+
+def record(key: str, value):
+    """
+    Sets `key` in the current request's report (no-op outside a request).
+    """
+    report = current_report.get()
+    if report is not None:
+        report[key] = value
+
+
+def increment(key: str, amount: int = 1):
+    report = current_report.get()
+    if report is not None:
+        report[key] = report.get(key, 0) + amount
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Times a pipeline stage. The duration and the process CPU time used meanwhile go to
+    Prometheus and are added to the request's `timings` breakdown. Stages that run once
+    per chunk are summed, so their total can exceed the wall time of the request. CPU
+    time is process-wide: it includes concurrent requests and excludes OCR worker processes.
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        STAGE_CPU_SECONDS.labels(stage).inc(cpu)
+        report = current_report.get()
+        if report is not None:
+            timing = report.setdefault("timings", {}).setdefault(stage, {"seconds": 0.0, "cpu_seconds": 0.0, "count": 0})
+            timing["seconds"] = round(timing["seconds"] + elapsed, 4)
+            timing["cpu_seconds"] = round(timing["cpu_seconds"] + cpu, 4)
+            timing["count"] += 1
+
+
+def observe_tokens(usage: dict, num_pages: int):
+    """
+    Records the token usage of one Gemini call spread over the pages it covered.
+    """
+    num_pages = max(num_pages, 1)
+    for kind in ("input", "output"):
+        per_page = usage[f"{kind}_tokens"] / num_pages
+        for _ in range(num_pages):
+            TOKENS_PER_PAGE.labels(kind).observe(per_page)
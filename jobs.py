@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import threading
+from contextlib import aclosing
+
+from .extractor import iter_document, ZERO_USAGE
+
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobStore:
+    """
+    SQLite-backed job queue. Jobs survive restarts, and the result of every finished
+    chunk is checkpointed so an interrupted job resumes with the chunks it has not done yet.
+    Checkpoint indices refer to the chunk plan of the first run, which is stored with the
+    job and reused on resume. The store can be shared by several worker processes: each
+    running job records its owner and a heartbeat, so only jobs of dead workers are put
+    back in the queue.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " document TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " chunks_total INTEGER,"
+            " total_item_count INTEGER,"
+            " token_usage TEXT,"
+            " metadata TEXT,"
+            " error TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);"
+            "CREATE TABLE IF NOT EXISTS job_chunks ("
+            " job_id TEXT NOT NULL,"
+            " chunk_index INTEGER NOT NULL,"
+            " pages TEXT NOT NULL,"
+            " token_usage TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, chunk_index));"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("worker", "TEXT"), ("heartbeat", "REAL"), ("chunk_plan", "TEXT")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._conn.commit()
+
+    def create(self, document: str) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, document, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, document, QUEUED, now, now),
+            )
+            self._conn.commit()
+        return job_id
+
+    def claim_next(self):
+        """
+        Atomically moves the oldest queued job to running and returns it.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, document FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ?, worker = ?, heartbeat = ? WHERE id = ? AND status = ?",
+                (RUNNING, now, _worker_id(), now, row[0], QUEUED),
+            ).rowcount
+            self._conn.commit()
+        if not updated:
+            return None
+        return {"id": row[0], "document": row[1]}
+
+    def requeue_running(self) -> int:
+        """
+        Puts jobs left running by a crashed or stopped process back in the queue: jobs of
+        processes on this host that no longer exist, and jobs whose heartbeat is stale.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, worker, heartbeat FROM jobs WHERE status = ?", (RUNNING,)
+            ).fetchall()
+            stale = [job_id for job_id, worker, heartbeat in rows
+                     if heartbeat is None or now - heartbeat > JOB_STALE_SECONDS or _is_dead_local_worker(worker)]
+            for job_id in stale:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, updated_at = ?, worker = NULL WHERE id = ? AND status = ?",
+                    (QUEUED, now, job_id, RUNNING),
+                )
+            self._conn.commit()
+        return len(stale)
+
+    def heartbeat(self, job_ids: list[str]) -> list[str]:
+        """
+        Refreshes the heartbeat of the given running jobs and returns those that were
+        cancelled (possibly through another worker) in the meantime.
+        """
+        if not job_ids:
+            return []
+        placeholders = ",".join("?" * len(job_ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE status = ? AND id IN ({placeholders})",
+                (time.time(), RUNNING, *job_ids),
+            )
+            self._conn.commit()
+            rows = self._conn.execute(
+                f"SELECT id FROM jobs WHERE status = ? AND id IN ({placeholders})", (CANCELLED, *job_ids)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def save_chunk(self, job_id: str, chunk_index: int, pages: list, token_usage: dict, chunks_total: int | None = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_chunks (job_id, chunk_index, pages, token_usage) VALUES (?, ?, ?, ?)",
+                (job_id, chunk_index, json.dumps(pages), json.dumps(token_usage)),
+            )
+            self._conn.execute(
+                "UPDATE jobs SET updated_at = ?, chunks_total = COALESCE(?, chunks_total) WHERE id = ?",
+                (time.time(), chunks_total, job_id),
+            )
+            self._conn.commit()
+
+    def save_plan(self, job_id: str, plan: list[dict]):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET chunk_plan = ?, chunks_total = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(plan), len(plan), time.time(), job_id),
+            )
+            self._conn.commit()
+
+    def load_plan(self, job_id: str) -> list[dict] | None:
+        with self._lock:
+            row = self._conn.execute("SELECT chunk_plan FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def load_chunks(self, job_id: str) -> dict:
+        """
+        Returns the checkpointed chunks of a job as {chunk_index: (pages, token_usage)}.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_index, pages, token_usage FROM job_chunks WHERE job_id = ? ORDER BY chunk_index",
+                (job_id,),
+            ).fetchall()
+        return {index: (json.loads(pages), json.loads(usage)) for index, pages, usage in rows}
+
+    def finish(self, job_id: str, status: str, total_item_count: int | None = None,
+               token_usage: dict | None = None, metadata: dict | None = None, error: str | None = None):
+        """
+        Records the final state of a job unless it was cancelled in the meantime.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ?, total_item_count = ?, token_usage = ?, metadata = ?, error = ?"
+                " WHERE id = ? AND status != ?",
+                (status, time.time(), total_item_count,
+                 json.dumps(token_usage) if token_usage is not None else None,
+                 json.dumps(metadata) if metadata is not None else None,
+                 error, job_id, CANCELLED),
+            )
+            self._conn.commit()
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING),
+            ).rowcount
+            self._conn.commit()
+        return bool(updated)
+
+    def get(self, job_id: str):
+        """
+        Returns the job with its (possibly partial) results in document order, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, document, status, created_at, updated_at, chunks_total, total_item_count,"
+                " token_usage, metadata, error FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        chunks = self.load_chunks(job_id)
+        pages = [page for index in sorted(chunks) for page in chunks[index][0]]
+        token_usage = json.loads(row[7]) if row[7] else _sum_usage(usage for _, usage in chunks.values())
+        return {
+            "job_id": row[0],
+            "document": row[1],
+            "status": row[2],
+            "created_at": row[3],
+            "updated_at": row[4],
+            "chunks_done": len(chunks),
+            "chunks_total": row[5],
+            "total_item_count": row[6] if row[6] is not None else sum(len(p.get("bill_items", [])) for p in pages),
+            "pagewise_line_items": pages,
+            "token_usage": token_usage,
+            "metadata": json.loads(row[8]) if row[8] else None,
+            "error": row[9],
+        }
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_dead_local_worker(worker: str | None) -> bool:
+    host, _, pid = (worker or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def _sum_usage(usages) -> dict:
+    total = dict(ZERO_USAGE)
+    for usage in usages:
+        for key in total:
+            total[key] += usage.get(key, 0)
+    return total
+
+
+class JobRunner:
+    """
+    Pool of background workers that take jobs from the store and run them through iter_document.
+    A maintenance task keeps the heartbeat of running jobs fresh, stops jobs cancelled
+    through another process, and requeues jobs of workers that died.
+    """
+
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._tasks = []
+        self._running = {}
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        requeued = self.store.requeue_running()
+        if requeued:
+            print(f"Resuming {requeued} interrupted job(s).")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, document: str) -> str:
+        job_id = await asyncio.to_thread(self.store.create, document)
+        self._wakeup.set()
+        return job_id
+
+    async def cancel(self, job_id: str) -> bool:
+        cancelled = await asyncio.to_thread(self.store.cancel, job_id)
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        return cancelled
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                for job_id in await asyncio.to_thread(self.store.heartbeat, list(self._running)):
+                    task = self._running.get(job_id)
+                    if task is not None:
+                        task.cancel()
+                requeued = await asyncio.to_thread(self.store.requeue_running)
+                if requeued:
+                    print(f"Requeued {requeued} job(s) of a stopped worker.")
+                    self._wakeup.set()
+            except Exception as e:
+                print(f"Job maintenance failed: {e}")
+
+    async def _worker(self):
+        while True:
+            job = await asyncio.to_thread(self.store.claim_next)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._run(job))
+            self._running[job["id"]] = task
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.done():
+                    # Shutdown: stop the job and leave it running so it is resumed on restart.
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise
+            finally:
+                self._running.pop(job["id"], None)
+
+    async def _run(self, job: dict):
+        job_id = job["id"]
+        checkpoints = await asyncio.to_thread(self.store.load_chunks, job_id)
+        plan = await asyncio.to_thread(self.store.load_plan, job_id)
+        if checkpoints:
+            print(f"Job {job_id}: resuming after {len(checkpoints)} checkpointed chunk(s).")
+
+        pending_pages = {}
+        planning_usage = dict(ZERO_USAGE)
+        try:
+            async with aclosing(iter_document(job["document"], completed_chunks=set(checkpoints), plan=plan)) as events:
+                async for event in events:
+                    if event["event"] == "progress" and event["stage"] == "planned":
+                        await asyncio.to_thread(self.store.save_plan, job_id, event["chunk_plan"])
+                        planning_usage = _sum_usage([planning_usage, event.get("token_usage", {})])
+                    elif event["event"] == "page":
+                        pending_pages.setdefault(event["chunk"], []).append(event["page"])
+                    elif event["event"] == "progress" and event["stage"] == "chunk_done":
+                        index = event["chunk"]
+                        pages = pending_pages.pop(index, [])
+                        checkpoints[index] = (pages, event["token_usage"])
+                        await asyncio.to_thread(
+                            self.store.save_chunk, job_id, index, pages, event["token_usage"], event["chunks_total"]
+                        )
+                    elif event["event"] == "summary":
+                        # Pages of a chunk that was never reported done are not lost.
+                        for index, pages in pending_pages.items():
+                            checkpoints[index] = (pages, dict(ZERO_USAGE))
+                            await asyncio.to_thread(self.store.save_chunk, job_id, index, pages, dict(ZERO_USAGE))
+                        pending_pages.clear()
+                        pages = [page for index in sorted(checkpoints) for page in checkpoints[index][0]]
+                        await asyncio.to_thread(
+                            self.store.finish, job_id, COMPLETED,
+                            sum(len(p.get("bill_items", [])) for p in pages),
+                            _sum_usage([planning_usage] + [usage for _, usage in checkpoints.values()]),
+                            event["metadata"],
+                        )
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            await asyncio.to_thread(self.store.finish, job_id, FAILED, error=str(e))
+
+
+job_store = JobStore(JOB_STORE_PATH)
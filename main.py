@@ -1,10 +1,31 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, CollectorRegistry, multiprocess
 from pydantic import BaseModel
-from .extractor import process_document
+from contextlib import asynccontextmanager, aclosing
+from .extractor import process_document, iter_document
+from .utils import close_http_client
+from .uploads import upload_manager
+from .jobs import JobRunner, job_store
+from .batch import process_batch
 import uvicorn
+import os
 import traceback
+import asyncio
+import json
 
-app = FastAPI(title="HackRx Bill Extraction API")
+job_runner = JobRunner(job_store)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_runner.start()
+    upload_manager.start()
+    yield
+    await job_runner.stop()
+    await upload_manager.stop()
+    await close_http_client()
+
+app = FastAPI(title="HackRx Bill Extraction API", lifespan=lifespan)
 
 class ExtractRequest(BaseModel):
     document: str
@@ -34,16 +55,18 @@ class ExtractResponse(BaseModel):
     token_usage: TokenUsage | None = None
     data: ExtractedData | None = None
     message: str | None = None
+    metadata: dict | None = None
 
 @app.post("/extract-bill-data", response_model=ExtractResponse)
 async def extract_bill_data(request: ExtractRequest):
     try:
-        data, usage = await process_document(request.document)
+        data, usage, metadata = await process_document(request.document)
         
         return ExtractResponse(
             is_success=True,
             token_usage=TokenUsage(**usage),
-            data=ExtractedData(**data)
+            data=ExtractedData(**data),
+            metadata=metadata
         )
     except Exception as e:
         traceback.print_exc()
@@ -52,5 +75,147 @@ async def extract_bill_data(request: ExtractRequest):
             message=f"Failed to process document. {str(e)}"
         )
 
+class BatchRequest(BaseModel):
+    documents: list[str]
+
+class BatchDocumentResult(BaseModel):
+    document: str
+    is_success: bool
+    deduplicated: bool = False
+    token_usage: TokenUsage | None = None
+    data: ExtractedData | None = None
+    message: str | None = None
+    metadata: dict | None = None
+
+class BatchResponse(BaseModel):
+    is_success: bool
+    token_usage: TokenUsage | None = None
+    results: list[BatchDocumentResult] = []
+    message: str | None = None
+
+def _batch_result(result: dict) -> BatchDocumentResult:
+    try:
+        return BatchDocumentResult(**result)
+    except Exception as e:
+        # The model returned data that does not fit the schema; fail just this document.
+        return BatchDocumentResult(document=result["document"], is_success=False,
+                                   message=f"Failed to process document. {str(e)}")
+
+@app.post("/extract-bill-data/batch", response_model=BatchResponse)
+async def extract_bill_data_batch(request: BatchRequest):
+    """
+    Extracts many documents in one request. Each document gets its own result,
+    and a failed document does not fail the batch.
+    """
+    try:
+        results = [_batch_result(r) for r in await process_batch(request.documents)]
+    except Exception as e:
+        traceback.print_exc()
+        return BatchResponse(is_success=False, message=f"Failed to process batch. {str(e)}")
+
+    total_usage = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+    for result in results:
+        if result.token_usage:
+            for key in total_usage:
+                total_usage[key] += getattr(result.token_usage, key)
+    return BatchResponse(is_success=True, token_usage=TokenUsage(**total_usage), results=results)
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    chunks_done: int = 0
+    chunks_total: int | None = None
+    token_usage: TokenUsage | None = None
+    data: ExtractedData | None = None
+    message: str | None = None
+    metadata: dict | None = None
+
+def _job_response(job: dict) -> JobResponse:
+    return JobResponse(
+        job_id=job["job_id"],
+        status=job["status"],
+        chunks_done=job["chunks_done"],
+        chunks_total=job["chunks_total"],
+        token_usage=TokenUsage(**job["token_usage"]),
+        data=ExtractedData(
+            pagewise_line_items=job["pagewise_line_items"],
+            total_item_count=job["total_item_count"]
+        ),
+        message=job["error"],
+        metadata=job["metadata"]
+    )
+
+@app.post("/jobs", response_model=JobResponse, status_code=202)
+async def create_job(request: ExtractRequest):
+    """
+    Queues a document for background extraction and returns the job ID immediately.
+    """
+    job_id = await job_runner.submit(request.document)
+    return JobResponse(job_id=job_id, status="queued")
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """
+    Returns the job status and the pages extracted so far.
+    """
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_response(job)
+
+@app.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """
+    Cancels a queued or running job. Already checkpointed pages remain available.
+    """
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    await job_runner.cancel(job_id)
+    return _job_response(await asyncio.to_thread(job_store.get, job_id))
+
+def _format_event(event: dict, sse: bool) -> str:
+    if sse:
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+@app.post("/extract-bill-data/stream")
+async def extract_bill_data_stream(request: ExtractRequest, http_request: Request):
+    """
+    Streams extraction events as NDJSON (or Server-Sent Events when the client
+    sends `Accept: text/event-stream`): progress events, one `page` event per
+    PageItem as soon as its chunk completes, and a final `summary` event.
+    """
+    sse = "text/event-stream" in http_request.headers.get("accept", "")
+
+    async def events():
+        try:
+            async with aclosing(iter_document(request.document)) as stream:
+                async for event in stream:
+                    if event["event"] == "page":
+                        event = {**event, "page": PageItem(**event["page"]).model_dump()}
+                    elif event["event"] == "summary":
+                        event = {**event, "token_usage": TokenUsage(**event["token_usage"]).model_dump()}
+                    yield _format_event(event, sse)
+        except Exception as e:
+            traceback.print_exc()
+            yield _format_event({"event": "error", "message": f"Failed to process document. {str(e)}"}, sse)
+
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type)
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics: per-stage latency histograms, retries, JSON repairs,
+    fallbacks, cache hits and tokens per page. Under Gunicorn (PROMETHEUS_MULTIPROC_DIR
+    set) the metrics of all worker processes are aggregated.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,219 @@
+import os
+import time
+import asyncio
+import resource
+from collections import deque
+from contextlib import asynccontextmanager
+
+from .instrumentation import span, record, increment, current_report, MEMORY_RESERVED, PEAK_RSS, ADMISSION_REJECTIONS
+
+# Per-process RSS budget for document processing; 0 turns admission control off.
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+# Estimated peak memory per byte of document (the data, the parsed PDF and its chunk slices).
+MEMORY_DOCUMENT_FACTOR = float(os.getenv("MEMORY_DOCUMENT_FACTOR", "3"))
+MEMORY_REQUEST_BASE_MB = float(os.getenv("MEMORY_REQUEST_BASE_MB", "16"))
+# Size assumed for a download without a Content-Length until its body has been read.
+MEMORY_UNKNOWN_SIZE_MB = float(os.getenv("MEMORY_UNKNOWN_SIZE_MB", "8"))
+MEMORY_OVERSIZE_POLICY = os.getenv("MEMORY_OVERSIZE_POLICY", "queue")  # "queue" runs it alone, "reject" fails it
+MEMORY_ADMISSION_TIMEOUT = float(os.getenv("MEMORY_ADMISSION_TIMEOUT", "300"))
+MEMORY_SAMPLE_SECONDS = float(os.getenv("MEMORY_SAMPLE_SECONDS", "0.2"))
+
+MB = 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class MemoryBudgetError(Exception):
+    """
+    Raised when a document does not fit the memory budget (MEMORY_OVERSIZE_POLICY=reject)
+    or waits longer than MEMORY_ADMISSION_TIMEOUT for memory to free up.
+    """
+
+
+def current_rss() -> int:
+    """
+    Resident set size of this process in bytes. Falls back to the peak RSS where
+    /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def estimate_document_memory(size: int | None, in_memory: bool = True) -> int:
+    """
+    Estimated peak memory of processing a document of `size` bytes (None when the size is
+    not known yet). A document spilled to disk does not hold its bytes in memory.
+    """
+    if size is None:
+        size = int(MEMORY_UNKNOWN_SIZE_MB * MB)
+    factor = MEMORY_DOCUMENT_FACTOR if in_memory else max(MEMORY_DOCUMENT_FACTOR - 1, 1)
+    return int(size * factor + MEMORY_REQUEST_BASE_MB * MB)
+
+
+class RSSSampler:
+    """
+    Samples the process RSS every `interval` seconds while any request is being
+    tracked, and keeps the peak seen during each tracked request.
+    """
+
+    def __init__(self, interval: float = MEMORY_SAMPLE_SECONDS):
+        self.interval = interval
+        self._active = {}
+        self._task = None
+
+    def _sample(self):
+        rss = current_rss()
+        for tracker in self._active.values():
+            tracker["peak"] = max(tracker["peak"], rss)
+
+    async def _run(self):
+        while self._active:
+            self._sample()
+            await asyncio.sleep(self.interval)
+        self._task = None
+
+    @asynccontextmanager
+    async def track(self):
+        """
+        Tracks the peak RSS while the body runs and records it in the current report
+        as `peak_rss_mb`.
+        """
+        key = object()
+        tracker = self._active[key] = {"peak": current_rss()}
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        try:
+            yield tracker
+        finally:
+            self._sample()
+            del self._active[key]
+            peak_mb = round(tracker["peak"] / MB, 1)
+            PEAK_RSS.observe(peak_mb)
+            report = current_report.get()
+            if report is not None:
+                report["peak_rss_mb"] = max(report.get("peak_rss_mb", 0), peak_mb)
+
+
+class Reservation:
+    """
+    The memory held by one admitted document. `resize` adjusts it once the real size is
+    known; growing does not wait, since the document is already admitted.
+    """
+
+    def __init__(self, budget: "MemoryBudget", amount: int):
+        self.budget = budget
+        self.amount = amount
+
+    async def resize(self, amount: int):
+        if self.budget.enabled and amount > self.budget.budget and self.budget.policy == "reject":
+            raise self.budget.oversize(amount)
+        await self.budget.adjust(amount - self.amount)
+        self.amount = amount
+        record("memory_reserved_mb", round(amount / MB, 1))
+
+    async def release(self):
+        await self.budget.adjust(-self.amount)
+        self.amount = 0
+
+
+class MemoryBudget:
+    """
+    Admission control for document processing. Each document reserves its estimated
+    memory; documents are admitted in arrival order while the reservations and the
+    measured RSS stay within the budget. A document larger than the whole budget is
+    rejected, or (queue policy) waits until nothing else runs and then runs alone.
+    """
+
+    def __init__(self, budget_mb: float = MEMORY_BUDGET_MB, policy: str = MEMORY_OVERSIZE_POLICY,
+                 timeout: float = MEMORY_ADMISSION_TIMEOUT):
+        self.budget = int(budget_mb * MB)
+        self.policy = policy
+        self.timeout = timeout
+        self.reserved = 0
+        self._waiting = deque()
+        self._condition = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def _fits(self, amount: int) -> bool:
+        if self.reserved == 0:
+            return True
+        return self.reserved + amount <= self.budget and current_rss() + amount <= self.budget
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def oversize(self, amount: int) -> MemoryBudgetError:
+        ADMISSION_REJECTIONS.labels("oversize").inc()
+        return MemoryBudgetError(
+            f"Document needs about {amount // MB} MB, more than the memory budget of {self.budget // MB} MB."
+        )
+
+    async def adjust(self, delta: int):
+        """
+        Changes the reserved total by `delta` bytes without waiting.
+        """
+        if not self.enabled or delta == 0:
+            return
+        async with self._get_condition():
+            self.reserved += delta
+            MEMORY_RESERVED.set(self.reserved)
+            self._condition.notify_all()
+
+    async def reserve(self, amount: int) -> Reservation:
+        """
+        Waits until `amount` bytes can be reserved and returns the reservation, which the
+        caller must release.
+        """
+        if not self.enabled:
+            return Reservation(self, amount)
+        if amount > self.budget and self.policy == "reject":
+            raise self.oversize(amount)
+
+        ticket = object()
+        deadline = time.monotonic() + self.timeout
+        async with self._get_condition():
+            self._waiting.append(ticket)
+            try:
+                with span("memory_wait"):
+                    while self._waiting[0] is not ticket or not self._fits(amount):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            ADMISSION_REJECTIONS.labels("timeout").inc()
+                            raise MemoryBudgetError("Server is out of memory budget; try again later.")
+                        try:
+                            # RSS can drop without a release, so poll as well.
+                            await asyncio.wait_for(self._condition.wait(), min(remaining, 0.5))
+                        except asyncio.TimeoutError:
+                            pass
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+            self.reserved += amount
+            MEMORY_RESERVED.set(self.reserved)
+        record("memory_reserved_mb", round(amount / MB, 1))
+        if amount > self.budget:
+            increment("memory_oversize")
+        return Reservation(self, amount)
+
+    @asynccontextmanager
+    async def admit(self, amount: int):
+        """
+        Holds a reservation of `amount` bytes while the body runs, waiting for one first.
+        """
+        reservation = await self.reserve(amount)
+        try:
+            yield reservation
+        finally:
+            await reservation.release()
+
+
+rss_sampler = RSSSampler()
+memory_budget = MemoryBudget()
@@ -0,0 +1,129 @@
+import re
+import json
+import time
+import random
+import asyncio
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+
+PAGE_MARKER_RE = re.compile(r"\[Page (\d+) OCR\]")
+
+
+class MockConfig:
+    """
+    Behaviour of the stubbed Gemini API. Latencies are in seconds; rates are probabilities per call.
+    """
+
+    def __init__(self, latency: float = 0.8, jitter: float = 0.3, upload_latency: float = 0.2,
+                 error_rate: float = 0.0, malformed_rate: float = 0.0, items_per_page: int = 12, seed: int = 1234):
+        self.latency = latency
+        self.jitter = jitter
+        self.upload_latency = upload_latency
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.items_per_page = items_per_page
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.uploads = 0
+        self.deletes = 0
+
+    def delay(self, base: float) -> float:
+        if base <= 0:
+            return 0.0
+        return max(0.0, base + self.random.uniform(-self.jitter, self.jitter))
+
+
+class MockResponse:
+    def __init__(self, text: str, prompt_tokens: int, output_tokens: int):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+
+
+class MockStreamResponse(MockResponse):
+    """
+    Streamed response: iterating yields chunks of the text, like AsyncGenerateContentResponse.
+    """
+
+    def __init__(self, text: str, prompt_tokens: int, output_tokens: int, chunk_size: int = 64):
+        super().__init__(text, prompt_tokens, output_tokens)
+        self.chunk_size = chunk_size
+
+    async def __aiter__(self):
+        for i in range(0, len(self.text), self.chunk_size):
+            yield SimpleNamespace(text=self.text[i:i + self.chunk_size])
+            await asyncio.sleep(0)
+
+
+def _prompt_text(contents) -> str:
+    if isinstance(contents, (list, tuple)):
+        return "".join(part for part in contents if isinstance(part, str))
+    return contents if isinstance(contents, str) else ""
+
+
+def _fake_output(prompt: str, config: MockConfig) -> str:
+    pages = [int(n) for n in PAGE_MARKER_RE.findall(prompt)] or [1]
+    pagewise = []
+    for page_no in pages:
+        items = []
+        for i in range(config.items_per_page):
+            qty = config.random.randint(1, 5)
+            rate = round(config.random.uniform(10, 500), 2)
+            items.append([f"Item {page_no}-{i + 1}", round(rate * qty, 2), rate, qty])
+        pagewise.append({"page_no": str(page_no), "page_type": "Bill Detail", "bill_items": items})
+    return json.dumps({"pagewise_line_items": pagewise, "total_item_count": len(pages) * config.items_per_page},
+                      separators=(",", ":"))
+
+
+class MockGenerativeModel:
+    """
+    Stand-in for genai.GenerativeModel with configurable latency, failures and malformed JSON.
+    """
+
+    def __init__(self, config: MockConfig, model_name: str = "models/mock-gemini"):
+        self.config = config
+        self.model_name = model_name
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        config = self.config
+        config.calls += 1
+        await asyncio.sleep(config.delay(config.latency))
+        if config.random.random() < config.error_rate:
+            raise google_exceptions.ServiceUnavailable("Service Unavailable (mock)")
+
+        prompt = _prompt_text(contents)
+        text = _fake_output(prompt, config)
+        if config.random.random() < config.malformed_rate:
+            text = text[: config.random.randint(1, max(1, len(text) - 1))]
+        pages = max(1, len(PAGE_MARKER_RE.findall(prompt)))
+        response_class = MockStreamResponse if stream else MockResponse
+        return response_class(text, len(prompt) // 4 + 258 * pages, len(text) // 4)
+
+
+def install(extractor_module, config: MockConfig):
+    """
+    Replaces the Gemini model and the genai file API used by `extractor_module` (and its
+    upload manager) with local stubs.
+    """
+    def upload_file(path, mime_type=None, **kwargs):
+        config.uploads += 1
+        time.sleep(config.delay(config.upload_latency))
+        return SimpleNamespace(name=f"files/mock-{config.uploads}", uri=f"mock://{config.uploads}", mime_type=mime_type)
+
+    def delete_file(name, **kwargs):
+        config.deletes += 1
+
+    stub = SimpleNamespace(
+        upload_file=upload_file,
+        delete_file=delete_file,
+        get_file=lambda name, **kwargs: SimpleNamespace(name=name),
+        list_models=lambda: [],
+    )
+    extractor_module.model = MockGenerativeModel(config)
+    extractor_module.genai = stub
+    extractor_module.upload_manager.client = stub
+    return stub
@@ -0,0 +1,273 @@
+import io
+import os
+import re
+import atexit
+import asyncio
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pytesseract
+from PIL import Image
+from pdf2image import convert_from_path
+
+from .utils import slice_pdf
+from .preprocess import prepare_for_ocr
+
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0")) or (os.cpu_count() or 1)
+OCR_MEMO_SIZE = int(os.getenv("OCR_MEMO_SIZE", "2048"))
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+TEXT_LAYER_ENABLED = os.getenv("TEXT_LAYER_ENABLED", "1") != "0"
+# "trimmed" sends only table-like lines and lines with numbers to the model; "full" sends the raw text.
+OCR_CONTEXT_MODE = os.getenv("OCR_CONTEXT_MODE", "full")
+OCR_CONTEXT_MAX_CHARS = int(os.getenv("OCR_CONTEXT_MAX_CHARS", "2000"))
+# When set, OCR runs on the shared OCR server (ocr_server.py) instead of a pool per process.
+OCR_SERVER_ADDRESS = os.getenv("OCR_SERVER_ADDRESS", "")
+
+DIGIT_RE = re.compile(r"\d")
+COLUMNS_RE = re.compile(r"\S(?: {2,}|\t| ?\| ?)\S")
+TABLE_HEADER_RE = re.compile(r"particulars|description|\bitem|\bqty\b|quantity|\brate\b|amount|total|\bmrp\b|price", re.IGNORECASE)
+
+_pool = None
+_memo = OrderedDict()
+_in_flight = {}
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        if OCR_SERVER_ADDRESS:
+            from .ocr_server import RemoteOCRPool
+            _pool = RemoteOCRPool(OCR_SERVER_ADDRESS)
+        else:
+            _pool = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+        atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+    return _pool
+
+
+def _tesseract(image) -> str:
+    """
+    Runs Tesseract on a PIL image through stdin/stdout, so no temporary image file
+    is written. Falls back to pytesseract if the pipe invocation fails.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="PPM" if image.mode in ("RGB", "L") else "PNG")
+    try:
+        result = subprocess.run(
+            [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout"],
+            input=buffer.getvalue(), capture_output=True, check=True,
+        )
+        return result.stdout.decode("utf-8", errors="replace")
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        return pytesseract.image_to_string(image)
+    except pytesseract.TesseractNotFoundError as e:
+        # This exception cannot be unpickled, which would break the process pool.
+        raise RuntimeError(str(e)) from None
+
+
+def _ocr_pdf_page(file_path: str, page_number: int, dpi: int) -> str:
+    """
+    Rasterizes a single page of a PDF on disk and runs Tesseract on it. Runs in the
+    OCR process pool, so only one page image per worker is ever held in memory.
+    """
+    images = convert_from_path(file_path, dpi=dpi, first_page=page_number, last_page=page_number)
+    if not images:
+        return ""
+    return _tesseract(prepare_for_ocr(images[0], "application/pdf"))
+
+
+def _ocr_pdf_slice(dpi: int, data: bytes) -> str:
+    """
+    Rasterizes a single-page in-memory PDF by piping it through pdftoppm and runs
+    Tesseract on the result, without touching the disk.
+    """
+    result = subprocess.run(["pdftoppm", "-r", str(dpi), "-"], input=data, capture_output=True, check=True)
+    with Image.open(io.BytesIO(result.stdout)) as image:
+        return _tesseract(prepare_for_ocr(image, "application/pdf"))
+
+
+def _ocr_image_file(source, mime_type: str = "image/jpeg") -> str:
+    """
+    OCRs an image (bytes or path) after orienting, cropping, downscaling and binarizing it.
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        return _tesseract(prepare_for_ocr(image, mime_type))
+
+
+def _has_fonts(resources) -> bool:
+    if resources is None:
+        return False
+    resources = resources.get_object()
+    if resources.get("/Font"):
+        return True
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return False
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        if xobject.get("/Subtype") == "/Form" and _has_fonts(xobject.get("/Resources")):
+            return True
+    return False
+
+
+def extract_text_layer(page) -> str:
+    """
+    Returns the embedded text of a PyPDF2 page, or "" if it cannot be read.
+    Pages without any font (plain scans) cannot carry text, so the slow
+    content-stream walk of extract_text is skipped for them.
+    """
+    try:
+        if not _has_fonts(page.get("/Resources")):
+            return ""
+        return page.extract_text() or ""
+    except Exception:
+        return ""
+
+
+def is_usable_text_layer(text: str) -> bool:
+    """
+    A text layer is usable when it has enough alphanumeric content, contains
+    numbers (bills always do), and is not mostly garbage glyphs.
+    """
+    if not TEXT_LAYER_ENABLED:
+        return False
+    stripped = "".join(text.split())
+    alnum = sum(1 for c in stripped if c.isalnum())
+    if alnum < TEXT_LAYER_MIN_CHARS or not any(c.isdigit() for c in stripped):
+        return False
+    return sum(1 for c in stripped if c.isprintable()) / len(stripped) > 0.9
+
+
+async def run_in_pool(func, *args):
+    """
+    Runs `func(*args)` in the OCR worker pool (local processes or the OCR server).
+    """
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), func, *args)
+
+
+async def _memoized(key: str, func, *args, prepare=None) -> str:
+    """
+    Runs `func(*args)` in the OCR pool at most once per key. Concurrent callers
+    for the same key share the in-flight result; failures are not memoized.
+    `prepare`, if given, is awaited only on a miss and returns extra arguments for `func`.
+    """
+    if key in _memo:
+        _memo.move_to_end(key)
+        return _memo[key]
+    if key in _in_flight:
+        return await asyncio.shield(_in_flight[key])
+
+    async def run():
+        extra = await prepare() if prepare is not None else ()
+        return await run_in_pool(func, *args, *extra)
+
+    future = asyncio.ensure_future(run())
+    _in_flight[key] = future
+    try:
+        text = await asyncio.shield(future)
+    finally:
+        _in_flight.pop(key, None)
+
+    _memo[key] = text
+    if len(_memo) > OCR_MEMO_SIZE:
+        _memo.popitem(last=False)
+    return text
+
+
+async def ocr_pdf_pages(source, page_hashes: list[str], text_layers: list[str] | None = None,
+                        reader=None, dpi: int = OCR_DPI):
+    """
+    Returns the text of every page of a PDF and how it was obtained ("text_layer" or "ocr").
+    `source` is the PDF's bytes (with its open PyPDF2 `reader`) or a path on disk.
+    Pages with a usable embedded text layer skip rasterization and Tesseract entirely;
+    the rest are OCR'd one page per task. OCR results are memoized by content hash,
+    so a page is rasterized and OCR'd once no matter how the document is later chunked or retried.
+    In-memory PDFs send only a one-page slice to the OCR worker, and at most two slices
+    per worker are cut ahead, so a long PDF is never held as page slices all at once.
+    """
+    # The reader seeks in one shared stream, so slices are cut one at a time.
+    slice_lock = asyncio.Lock()
+    pages_in_flight = asyncio.Semaphore(OCR_WORKERS * 2)
+
+    async def one(index: int, page_hash: str):
+        if text_layers is not None and is_usable_text_layer(text_layers[index]):
+            return text_layers[index], "text_layer"
+        key = f"{page_hash}:{dpi}"
+        try:
+            if not isinstance(source, bytes):
+                return await _memoized(key, _ocr_pdf_page, source, index + 1, dpi), "ocr"
+
+            async def page_slice():
+                async with slice_lock:
+                    return (await asyncio.to_thread(slice_pdf, reader, index, index + 1),)
+
+            async with pages_in_flight:
+                return await _memoized(key, _ocr_pdf_slice, dpi, prepare=page_slice), "ocr"
+        except Exception as e:
+            print(f"PDF OCR failed for page {index + 1}: {e}")
+            return f"OCR failed for page: {e}", "ocr_failed"
+
+    results = await asyncio.gather(*[one(i, h) for i, h in enumerate(page_hashes)])
+    return [text for text, _ in results], [mode for _, mode in results]
+
+
+async def ocr_image(source, content_hash: str, mime_type: str = "image/jpeg") -> str:
+    """
+    OCRs an image (bytes or path), memoized by the image's content hash.
+    """
+    try:
+        return await _memoized(content_hash, _ocr_image_file, source, mime_type)
+    except Exception as e:
+        print(f"OCR Failed: {e}")
+        return f"OCR Failed: {e}"
+
+
+def trim_ocr_text(text: str, max_chars: int = OCR_CONTEXT_MAX_CHARS) -> str:
+    """
+    Keeps the parts of a page's text that matter for line items: lines with numbers,
+    multi-column (table-like) lines, table headers, and single lines between such
+    lines (wrapped item names). Whitespace is normalized, noise lines are dropped
+    and the result is capped at `max_chars`.
+    """
+    lines = []
+    for raw in text.splitlines():
+        line = " ".join(raw.split())
+        if len(line) < 2 or sum(c.isalnum() for c in line) < 0.4 * len(line):
+            continue
+        keep = bool(DIGIT_RE.search(line) or COLUMNS_RE.search(raw.strip()) or TABLE_HEADER_RE.search(line))
+        lines.append((line, keep))
+
+    kept = {i for i, (_, keep) in enumerate(lines) if keep}
+    kept |= {i for i in range(1, len(lines) - 1) if i - 1 in kept and i + 1 in kept}
+
+    out, size = [], 0
+    for i in sorted(kept):
+        line = lines[i][0]
+        if size + len(line) + 1 > max_chars:
+            out.append("...")
+            break
+        out.append(line)
+        size += len(line) + 1
+    return "\n".join(out)
+
+
+def context_text(text: str) -> str:
+    """
+    The text of one page as it is sent to the model (see OCR_CONTEXT_MODE).
+    """
+    return trim_ocr_text(text) if OCR_CONTEXT_MODE == "trimmed" else text
+
+
+def format_ocr_context(texts: list[str], first_page: int = 1) -> str:
+    """
+    Joins per-page OCR text into the `{ocr_context}` block of the prompt.
+    """
+    ocr_text = ""
+    for i, text in enumerate(texts):
+        ocr_text += f"\n[Page {first_page + i} OCR]: {context_text(text)}\n"
+    if not ocr_text:
+        ocr_text = "OCR not available for this PDF (Image extraction failed)."
+    return ocr_text
@@ -0,0 +1,99 @@
+"""
+Dedicated OCR process pool shared by all web worker processes.
+
+Web workers started with OCR_SERVER_ADDRESS set send their rasterize + Tesseract and
+image preprocessing work here instead of running a process pool each, so OCR uses a fixed number of cores
+(OCR_WORKERS) no matter how many web workers there are. The Gunicorn config starts it
+automatically; it can also run on its own:
+
+    python -m bill_extractor.ocr_server    # listens on OCR_SERVER_ADDRESS
+
+The server unpickles what its clients send, so OCR_SERVER_AUTHKEY must be set to a
+secret shared with the web workers; there is no default.
+"""
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+from . import ocr
+from .preprocess import prepare_upload
+
+OCR_SERVER_ADDRESS = ocr.OCR_SERVER_ADDRESS or "127.0.0.1:50055"
+OCR_SERVER_AUTHKEY = os.getenv("OCR_SERVER_AUTHKEY", "").encode()
+OCR_CLIENT_CONCURRENCY = int(os.getenv("OCR_CLIENT_CONCURRENCY", "32"))
+
+# Only these functions can be run remotely.
+TASKS = {func.__name__: func for func in (ocr._ocr_pdf_page, ocr._ocr_pdf_slice, ocr._ocr_image_file, prepare_upload)}
+
+
+class OCRManager(BaseManager):
+    pass
+
+
+class OCRService:
+    def __init__(self, workers: int):
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+
+    def run(self, name: str, args: tuple):
+        return self._pool.submit(TASKS[name], *args).result()
+
+
+def parse_address(value: str):
+    """
+    "host:port" becomes a TCP address; anything else is a Unix socket path.
+    """
+    host, _, port = value.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return value
+
+
+def _authkey() -> bytes:
+    if not OCR_SERVER_AUTHKEY:
+        raise RuntimeError("OCR_SERVER_AUTHKEY must be set to a shared secret to use the OCR server.")
+    return OCR_SERVER_AUTHKEY
+
+
+def serve(address: str = OCR_SERVER_ADDRESS, workers: int = ocr.OCR_WORKERS):
+    authkey = _authkey()
+    service = OCRService(workers)
+    OCRManager.register("ocr", callable=lambda: service)
+    manager = OCRManager(address=parse_address(address), authkey=authkey)
+    print(f"OCR server listening on {address} with {workers} worker(s).")
+    manager.get_server().serve_forever()
+
+
+class RemoteOCRPool(Executor):
+    """
+    Executor that runs OCR tasks on the OCR server. Each calling thread keeps its own
+    connection, so up to OCR_CLIENT_CONCURRENCY tasks are in flight at once.
+    """
+
+    def __init__(self, address: str = OCR_SERVER_ADDRESS):
+        self.address = address
+        self._threads = ThreadPoolExecutor(max_workers=OCR_CLIENT_CONCURRENCY, thread_name_prefix="ocr-client")
+        self._service = None
+        self._lock = threading.Lock()
+
+    def _get_service(self):
+        with self._lock:
+            if self._service is None:
+                OCRManager.register("ocr")
+                manager = OCRManager(address=parse_address(self.address), authkey=_authkey())
+                manager.connect()
+                self._service = manager.ocr()
+            return self._service
+
+    def _call(self, name: str, args: tuple):
+        return self._get_service().run(name, args)
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self._threads.submit(self._call, fn.__name__, args)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self._threads.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+if __name__ == "__main__":
+    serve()
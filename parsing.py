@@ -0,0 +1,247 @@
+import re
+import json
+
+TRAILING_COMMA_RE = re.compile(r",(\s*[\]}])")
+BARE_DECIMAL_RE = re.compile(r"(\d)\.(?=\s*[,\]}])")
+NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+PAGE_NO_RE = re.compile(r"\d+")
+
+CLOSERS = {"{": "}", "[": "]"}
+
+
+class OutputParseError(ValueError):
+    """
+    Raised when a model response contains no usable page at all.
+    """
+
+
+def _loads(text: str):
+    """
+    json.loads with the repairs the model most often needs: trailing commas and bare decimals like `4.`.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(BARE_DECIMAL_RE.sub(r"\1.0", TRAILING_COMMA_RE.sub(r"\1", text)))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        match = NUMBER_RE.search(value.replace(",", ""))
+        if match:
+            return float(match.group())
+    return None
+
+
+def to_item(row) -> dict | None:
+    """
+    Converts a compact [name, amount, rate, qty] row (or an item object) into a
+    BillItem-shaped dict. Rows without a name are rejected.
+    """
+    if isinstance(row, dict):
+        name, amount, rate, quantity = (row.get("item_name"), row.get("item_amount"),
+                                        row.get("item_rate"), row.get("item_quantity"))
+    elif isinstance(row, list) and len(row) >= 2:
+        name, amount = row[0], row[1]
+        rate = row[2] if len(row) > 2 else None
+        quantity = row[3] if len(row) > 3 else 1
+    else:
+        return None
+
+    if name is None or not str(name).strip():
+        return None
+    quantity = _number(quantity)
+    return {
+        "item_name": str(name).strip(),
+        "item_amount": _number(amount),
+        "item_rate": _number(rate),
+        "item_quantity": quantity if quantity is not None else 1,
+    }
+
+
+def page_number(page: dict) -> int | None:
+    match = PAGE_NO_RE.search(str(page.get("page_no") or ""))
+    return int(match.group()) if match else None
+
+
+def complete_page(page: dict, page_no: int, page_type: str = "Bill Detail") -> dict:
+    """
+    Sets the document page number of an extracted page and fills in what the model left
+    out: a truncated page can be cut off before its page_type.
+    """
+    page["page_no"] = str(page_no)
+    if not page.get("page_type"):
+        page["page_type"] = page_type
+    page.setdefault("bill_items", [])
+    return page
+
+
+def assign_pages(pages: list[dict], expected: list[int], page_types: list[str] | None = None) -> dict:
+    """
+    Maps extracted pages to the document page numbers in `expected`. The model may number
+    pages absolutely, relative to the chunk (1..n), or not at all (then order is used).
+    Entries for the same page are merged. Pages that cannot be placed are dropped.
+    Every placed page gets its document page number, and `page_types` (one per expected
+    page) where the model gave none.
+    """
+    numbers = [page_number(p) for p in pages]
+    if all(n in expected for n in numbers):
+        placed = numbers
+    elif all(n is not None and 1 <= n <= len(expected) for n in numbers):
+        placed = [expected[n - 1] for n in numbers]
+    else:
+        placed = expected[:len(pages)]
+
+    assigned = {}
+    for number, page in zip(placed, pages):
+        if number in assigned:
+            assigned[number]["bill_items"].extend(page.get("bill_items", []))
+        else:
+            page_type = page_types[expected.index(number)] if page_types else "Bill Detail"
+            assigned[number] = complete_page(page, number, page_type)
+    return assigned
+
+
+class OutputParser:
+    """
+    Incremental, tolerant parser for the model's pagewise JSON. Feed it response text as
+    it streams in; every page is parsed as soon as its object closes, and bill item rows
+    are validated as they arrive. Code fences, text around the JSON, stray closing
+    brackets, trailing commas and bare decimals are tolerated. If the output is cut off,
+    finish() recovers the rows of the last, unfinished page.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pages = []
+        self.complete = False
+        self.rows_rejected = 0
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._page = None
+
+    def feed(self, chunk: str) -> list[dict]:
+        """
+        Adds streamed text and returns the pages completed by it.
+        """
+        self.text += chunk
+        completed = []
+        text = self.text
+        while self._pos < len(text) and not self.complete:
+            i = self._pos
+            c = text[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start:i]
+                continue
+
+            if c == '"':
+                if self._stack:
+                    self._in_string = True
+                    self._string_start = i + 1
+            elif c in CLOSERS:
+                self._open(c, i)
+            elif c in "]}":
+                page = self._close(c, i)
+                if page is not None:
+                    completed.append(page)
+        self.pages.extend(completed)
+        return completed
+
+    def _open(self, c: str, i: int):
+        key = self._last_string if self._stack and self._stack[-1][0] == "{" else None
+        self._last_string = None
+        self._stack.append((c, i, key))
+        path = [(kind, k) for kind, _, k in self._stack]
+
+        if c == "{" and len(path) == 3 and path[1] == ("[", "pagewise_line_items"):
+            self._page = {"start": i, "cut": None, "items": []}
+        elif self._page is not None and len(path) == 4 and path[3] == ("[", "bill_items"):
+            self._page["cut"] = i + 1
+
+    def _close(self, c: str, i: int):
+        if not self._stack:
+            return None
+        if CLOSERS[self._stack[-1][0]] != c:
+            # A stray closer (the model sometimes emits "}}"); skip it.
+            return None
+        kind, start, _ = self._stack.pop()
+        depth = len(self._stack)
+        self._last_string = None
+
+        if depth == 0:
+            self.complete = True
+            return None
+        if self._page is None:
+            return None
+        if depth == 4 and self._stack[3][2] == "bill_items":
+            self._row(self.text[start:i + 1])
+            self._page["cut"] = i + 1
+        elif depth == 2 and kind == "{":
+            page = self._parse_page(self.text[start:i + 1])
+            self._page = None
+            return page
+        return None
+
+    def _row(self, text: str):
+        try:
+            item = to_item(_loads(text))
+        except json.JSONDecodeError:
+            item = None
+        if item is None:
+            self.rows_rejected += 1
+        else:
+            self._page["items"].append(item)
+
+    def _parse_page(self, text: str) -> dict | None:
+        try:
+            page = _loads(text)
+        except json.JSONDecodeError:
+            return self._recover_page()
+        if not isinstance(page, dict):
+            return None
+        page["bill_items"] = self._page["items"]
+        return page
+
+    def _recover_page(self) -> dict | None:
+        """
+        Rebuilds the current page from its text up to the last complete row.
+        """
+        page, cut = self._page, self._page["cut"]
+        if cut is None:
+            return None
+        try:
+            recovered = _loads(self.text[page["start"]:cut].rstrip().rstrip(",") + "]}")
+        except json.JSONDecodeError:
+            return None
+        recovered["bill_items"] = page["items"]
+        return recovered
+
+    def finish(self) -> dict:
+        """
+        Ends the stream. Returns the completed pages, the recovered part of a page the
+        output was cut off in (or None), and whether the JSON was complete.
+        """
+        partial = self._recover_page() if self._page is not None and not self.complete else None
+        self._page = None
+        if not self.pages and partial is None:
+            raise OutputParseError(
+                f"Failed to parse LLM response as JSON. Length: {len(self.text)}. "
+                f"Start: {self.text[:200]}... End: ...{self.text[-200:]}"
+            )
+        return {"pages": self.pages, "partial_page": partial, "complete": self.complete}
@@ -0,0 +1,133 @@
+import os
+import re
+
+from .scheduler import TOKENS_PER_PAGE_IMAGE, estimate_tokens
+from .ocr import context_text
+
+CHUNK_INPUT_TOKEN_BUDGET = int(os.getenv("CHUNK_INPUT_TOKEN_BUDGET", "12000"))
+CHUNK_OUTPUT_TOKEN_BUDGET = int(os.getenv("CHUNK_OUTPUT_TOKEN_BUDGET", "4000"))
+CHUNK_MAX_PAGES = int(os.getenv("CHUNK_MAX_PAGES", "4"))
+
+# Rough cost of one extracted row in the compact [name, amount, rate, qty] format.
+OUTPUT_TOKENS_PER_ROW = 20
+OUTPUT_TOKENS_PER_PAGE = 40
+
+AMOUNT_RE = re.compile(r"\d+[.,]\d{2}\b")
+CONTINUED_RE = re.compile(r"carried\s+forward|c/f\b|contd|continued", re.IGNORECASE)
+BROUGHT_FORWARD_RE = re.compile(r"brought\s+forward|b/f\b", re.IGNORECASE)
+TOTAL_RE = re.compile(r"\btotal\b|net\s+payable|amount\s+payable|amount\s+due", re.IGNORECASE)
+HEADER_RE = re.compile(r"particulars|description|item|qty|quantity|rate|amount", re.IGNORECASE)
+
+PHARMACY_RE = re.compile(r"pharmacy|medicine|tablet|\btab\b|syrup|capsule|batch|expiry|\bexp\b", re.IGNORECASE)
+FINAL_BILL_RE = re.compile(r"final\s+bill|grand\s+total|net\s+payable|amount\s+payable|bill\s+summary", re.IGNORECASE)
+
+
+def guess_page_type(text: str) -> str:
+    """
+    Keyword guess of the page type, using the same categories as the prompt.
+    """
+    if FINAL_BILL_RE.search(text):
+        return "Final Bill"
+    if len(PHARMACY_RE.findall(text)) >= 2:
+        return "Pharmacy"
+    return "Bill Detail"
+
+
+def _lines(text: str) -> list[str]:
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def estimate_page(text: str) -> dict:
+    """
+    Estimates the Gemini cost of one page and whether its table runs over a page boundary.
+    """
+    lines = _lines(text)
+    rows = sum(1 for line in lines if AMOUNT_RE.search(line))
+    head, tail = lines[:5], lines[-5:]
+
+    ends_mid_table = bool(tail) and (
+        any(CONTINUED_RE.search(line) for line in tail)
+        or (any(AMOUNT_RE.search(line) for line in tail) and not any(TOTAL_RE.search(line) for line in tail))
+    )
+    starts_mid_table = bool(head) and (
+        any(BROUGHT_FORWARD_RE.search(line) for line in head)
+        or (AMOUNT_RE.search(head[0]) is not None and not any(HEADER_RE.search(line) for line in head))
+    )
+
+    return {
+        "input_tokens": TOKENS_PER_PAGE_IMAGE + estimate_tokens(context_text(text)),
+        "output_tokens": OUTPUT_TOKENS_PER_PAGE + rows * OUTPUT_TOKENS_PER_ROW,
+        "page_type": guess_page_type(text),
+        "ends_mid_table": ends_mid_table,
+        "starts_mid_table": starts_mid_table,
+    }
+
+
+def plan_chunks(page_texts: list[str], prompt_tokens: int,
+                input_budget: int = CHUNK_INPUT_TOKEN_BUDGET,
+                output_budget: int = CHUNK_OUTPUT_TOKEN_BUDGET,
+                max_pages: int = CHUNK_MAX_PAGES, skip: set[int] | None = None) -> list[dict]:
+    """
+    Groups consecutive pages into chunks so each Gemini call stays within the input
+    and output token budgets. A new chunk starts when a budget or `max_pages` would be
+    exceeded, or when the page type changes. A table that continues onto the next page
+    keeps the two pages together unless that would break the output budget, which is
+    the hard limit (exceeding it truncates the model's JSON). Pages in `skip` (0-based)
+    are left out, so no chunk spans them.
+
+    Each chunk is a dict with 0-based `start`, exclusive `end`, token estimates and the
+    reason it was closed, so the plan can be reported in the response metadata.
+    """
+    estimates = [estimate_page(text) for text in page_texts]
+    chunks = []
+    current = None
+
+    def close(reason: str):
+        current["reason"] = reason
+        chunks.append(current)
+
+    for index, est in enumerate(estimates):
+        if skip and index in skip:
+            if current is not None:
+                close("skipped_page")
+                current = None
+            continue
+        if current is not None:
+            pages = current["end"] - current["start"]
+            continues = estimates[index - 1]["ends_mid_table"] and est["starts_mid_table"]
+            over_output = current["estimated_output_tokens"] + est["output_tokens"] > output_budget
+            over_input = current["estimated_input_tokens"] + est["input_tokens"] > input_budget
+
+            reason = None
+            if over_output:
+                reason = "output_budget"
+            elif continues:
+                reason = None
+            elif over_input:
+                reason = "input_budget"
+            elif pages >= max_pages:
+                reason = "max_pages"
+            elif est["page_type"] != current["page_type"]:
+                reason = "page_type"
+
+            if reason is None:
+                current["end"] = index + 1
+                current["estimated_input_tokens"] += est["input_tokens"]
+                current["estimated_output_tokens"] += est["output_tokens"]
+                if continues:
+                    current["continued_table"] = True
+                continue
+            close(reason)
+
+        current = {
+            "start": index,
+            "end": index + 1,
+            "page_type": est["page_type"],
+            "estimated_input_tokens": prompt_tokens + est["input_tokens"],
+            "estimated_output_tokens": est["output_tokens"],
+            "continued_table": False,
+        }
+
+    if current is not None:
+        close("end")
+    return chunks
@@ -0,0 +1,148 @@
+import io
+import os
+import json
+
+from PIL import Image, ImageChops, ImageOps
+
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "1") != "0"
+
+# Long edge of an A4/Letter page in inches, used to turn a target DPI into pixels.
+PAGE_LONG_EDGE_INCHES = 11.7
+
+# Per mime type settings. Override any of them with IMAGE_PREPROCESS_CONFIG, e.g.
+# '{"image/png": {"upload_format": "PNG"}, "image/jpeg": {"ocr_dpi": 200}}'.
+DEFAULT_CONFIG = {
+    "image/jpeg": {"orient": True, "crop": True, "ocr_dpi": 300, "ocr_mode": "binarize",
+                   "upload_dpi": 200, "upload_format": "JPEG", "upload_quality": 85},
+    "image/png": {"orient": True, "crop": True, "ocr_dpi": 300, "ocr_mode": "binarize",
+                  "upload_dpi": 200, "upload_format": "JPEG", "upload_quality": 90},
+    # PDF pages are already rasterized at OCR_DPI; only the OCR copy is simplified.
+    "application/pdf": {"orient": False, "crop": False, "ocr_dpi": None, "ocr_mode": "grayscale"},
+}
+
+UPLOAD_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def _load_config() -> dict:
+    config = {mime: dict(settings) for mime, settings in DEFAULT_CONFIG.items()}
+    overrides = os.getenv("IMAGE_PREPROCESS_CONFIG")
+    if overrides:
+        for mime, settings in json.loads(overrides).items():
+            config.setdefault(mime, {}).update(settings)
+    return config
+
+
+PREPROCESS_CONFIG = _load_config()
+
+
+def settings_for(mime_type: str) -> dict:
+    return PREPROCESS_CONFIG.get(mime_type, PREPROCESS_CONFIG["image/jpeg"])
+
+
+def _crop_borders(image: Image.Image, threshold: int = 30, margin: int = 8) -> Image.Image:
+    """
+    Crops a uniform border (table, scanner bed) around the document, judged by the
+    colour of the top-left corner. Leaves the image alone if there is little to gain.
+    """
+    gray = image.convert("L")
+    background = Image.new("L", gray.size, gray.getpixel((0, 0)))
+    bbox = ImageChops.difference(gray, background).point(lambda p: 255 if p > threshold else 0).getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - margin), max(0, top - margin), min(image.width, right + margin), min(image.height, bottom + margin))
+    if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) > 0.95 * image.width * image.height:
+        return image
+    return image.crop(bbox)
+
+
+def _downscale(image: Image.Image, dpi: int | None) -> Image.Image:
+    if not dpi:
+        return image
+    max_edge = round(PAGE_LONG_EDGE_INCHES * dpi)
+    if max(image.size) <= max_edge:
+        return image
+    image = image.copy()
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return image
+
+
+def _otsu_threshold(gray: Image.Image) -> int:
+    histogram = gray.histogram()
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_background = weight_background = 0
+    best, threshold = 0.0, 128
+    for i, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += i * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        between = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if between > best:
+            best, threshold = between, i
+    return threshold
+
+
+def _normalize(image: Image.Image, settings: dict) -> Image.Image:
+    if settings.get("orient"):
+        image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if settings.get("crop"):
+        image = _crop_borders(image)
+    return image
+
+
+def prepare_for_ocr(image: Image.Image, mime_type: str) -> Image.Image:
+    """
+    Returns the copy of an image that Tesseract sees: oriented, cropped, downscaled to
+    `ocr_dpi` and converted to grayscale or a binarized (Otsu) black-and-white image.
+    Runs in the OCR worker.
+    """
+    if not IMAGE_PREPROCESS_ENABLED:
+        return image
+    settings = settings_for(mime_type)
+    image = _downscale(_normalize(image, settings), settings.get("ocr_dpi"))
+    mode = settings.get("ocr_mode")
+    if mode in ("grayscale", "binarize"):
+        image = image.convert("L")
+    if mode == "binarize":
+        threshold = _otsu_threshold(image)
+        image = image.point(lambda p: 255 if p > threshold else 0, mode="1")
+    return image
+
+
+def prepare_upload(source, mime_type: str):
+    """
+    Returns (data, mime_type) of the copy of an image that is sent to Gemini: oriented,
+    cropped, downscaled to `upload_dpi` and recompressed. The original is returned when
+    preprocessing is off, the image cannot be read, or recompressing does not make it
+    smaller. Runs in the OCR worker pool.
+    """
+    original = source if isinstance(source, bytes) else None
+    if not IMAGE_PREPROCESS_ENABLED or not mime_type.startswith("image/"):
+        return source, mime_type
+    settings = settings_for(mime_type)
+    try:
+        with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+            image = _downscale(_normalize(image, settings), settings.get("upload_dpi"))
+            upload_format = settings.get("upload_format", "JPEG")
+            if upload_format == "JPEG" and image.mode != "L":
+                image = image.convert("RGB")
+            out = io.BytesIO()
+            image.save(out, format=upload_format, quality=settings.get("upload_quality", 85), optimize=True)
+    except Exception as e:
+        print(f"Image preprocessing failed, uploading the original: {e}")
+        return source, mime_type
+
+    data = out.getvalue()
+    size = len(original) if original is not None else os.path.getsize(source)
+    if len(data) >= size:
+        return source, mime_type
+    return data, UPLOAD_MIME_TYPES.get(upload_format, mime_type)
@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+
+import httpx
+import requests
+from google.api_core import exceptions as google_exceptions
+
+from .parsing import OutputParseError
+from .instrumentation import (
+    span, increment, record,
+    RETRIES, RETRY_BUDGET_EXHAUSTED, BREAKER_STATE, BREAKER_REJECTIONS,
+)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_RATE_LIMIT_BASE_DELAY = float(os.getenv("RETRY_RATE_LIMIT_BASE_DELAY", "2.0"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN = float(os.getenv("RETRY_BUDGET_MIN", "10"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+BREAKER_MODE = os.getenv("BREAKER_MODE", "queue")  # "queue" waits for recovery, "fail" fails fast
+BREAKER_MAX_WAIT_SECONDS = float(os.getenv("BREAKER_MAX_WAIT_SECONDS", "120"))
+
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+PARSE = "parse"
+FATAL = "fatal"
+
+RATE_LIMIT_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError, google_exceptions.BadGateway,
+    google_exceptions.GatewayTimeout, google_exceptions.DeadlineExceeded, google_exceptions.Aborted,
+    google_exceptions.Unknown, asyncio.TimeoutError, ConnectionError,
+)
+FATAL_ERRORS = (
+    google_exceptions.InvalidArgument, google_exceptions.BadRequest, google_exceptions.PermissionDenied,
+    google_exceptions.Unauthenticated, google_exceptions.Unauthorized, google_exceptions.NotFound,
+    google_exceptions.FailedPrecondition,
+)
+PARSE_ERRORS = (OutputParseError, json.JSONDecodeError)
+# Errors that come from the API or the connection to it. Only these are classified by
+# their message and count towards the circuit breaker; anything else is a local bug.
+CONNECTION_ERRORS = (
+    ConnectionError, TimeoutError, asyncio.TimeoutError, httpx.TransportError,
+    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+)
+UPSTREAM_ERRORS = (google_exceptions.GoogleAPIError,) + CONNECTION_ERRORS + PARSE_ERRORS
+
+RETRY_DELAY_RE = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)|retry in ([\d.]+)\s*s", re.IGNORECASE)
+RATE_LIMIT_MESSAGE_RE = re.compile(r"\b429\b|quota|rate.?limit|resource.?exhausted", re.IGNORECASE)
+TRANSIENT_MESSAGE_RE = re.compile(r"\b50[0234]\b|unavailable|overloaded|timed? ?out|deadline|connection", re.IGNORECASE)
+FATAL_MESSAGE_RE = re.compile(r"\b40[0134]\b|invalid|permission|api key|not found", re.IGNORECASE)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling Gemini while the circuit breaker is open.
+    """
+
+
+def is_upstream(error: BaseException) -> bool:
+    """
+    Whether the error came from the Gemini API or the connection to it.
+    """
+    return isinstance(error, UPSTREAM_ERRORS)
+
+
+def classify(error: BaseException) -> str:
+    """
+    Sorts an error into rate_limit, transient, parse or fatal. API and connection errors
+    without a recognizable type are classified by their message; any other exception
+    (a bug such as a KeyError) is fatal and not retried.
+    """
+    if isinstance(error, PARSE_ERRORS):
+        return PARSE
+    if isinstance(error, RATE_LIMIT_ERRORS):
+        return RATE_LIMIT
+    if isinstance(error, TRANSIENT_ERRORS):
+        return TRANSIENT
+    if isinstance(error, FATAL_ERRORS):
+        return FATAL
+    if not is_upstream(error):
+        return FATAL
+    message = str(error)
+    if RATE_LIMIT_MESSAGE_RE.search(message):
+        return RATE_LIMIT
+    if TRANSIENT_MESSAGE_RE.search(message):
+        return TRANSIENT
+    if FATAL_MESSAGE_RE.search(message):
+        return FATAL
+    return TRANSIENT if isinstance(error, CONNECTION_ERRORS) else FATAL
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Returns the server's retry hint in seconds (Retry-After header or RetryInfo), if any.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            pass
+    match = RETRY_DELAY_RE.search(str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return None
+
+
+def backoff_delay(kind: str, attempt: int, hint: float | None = None) -> float:
+    """
+    Exponential backoff with full jitter. Parse errors retry at once; a retry-after hint
+    is a lower bound.
+    """
+    if kind == PARSE:
+        return 0.0
+    base = RETRY_RATE_LIMIT_BASE_DELAY if kind == RATE_LIMIT else RETRY_BASE_DELAY
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, base * 2 ** attempt))
+    if hint is not None:
+        delay = max(delay, min(hint, RETRY_MAX_DELAY))
+    return delay
+
+
+class RetryBudget:
+    """
+    Caps retries across all requests: every first attempt deposits `ratio` tokens and every
+    retry spends one, with at most `minimum` saved up. During an outage retries stay a
+    fraction of normal traffic instead of multiplying it.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, minimum: float = RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.tokens = minimum
+
+    def deposit(self):
+        self.tokens = min(self.minimum, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive upstream failures (rate limits and transient errors).
+    While open, calls wait for the cooldown (BREAKER_MODE=queue) or fail fast (fail).
+    After the cooldown a single probe call is let through; its outcome closes the
+    breaker or opens it again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN_SECONDS,
+                 mode: str = BREAKER_MODE, max_wait: float = BREAKER_MAX_WAIT_SECONDS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.mode = mode
+        self.max_wait = max_wait
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            print(f"Gemini circuit breaker {self.state} -> {state}")
+        self.state = state
+        BREAKER_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state])
+
+    async def before_call(self):
+        """
+        Waits until a call may go out, or raises CircuitOpenError.
+        """
+        deadline = time.monotonic() + self.max_wait
+        waited = False
+        while True:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+
+            if self.mode == "fail" or time.monotonic() >= deadline:
+                BREAKER_REJECTIONS.inc()
+                increment("breaker_rejections")
+                raise CircuitOpenError("Gemini is unavailable (circuit breaker open); try again later.")
+            if not waited:
+                waited = True
+                record("breaker", self.state)
+            with span("breaker_wait"):
+                await asyncio.sleep(max(0.05, min(remaining, 1.0)))
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def abandon(self):
+        """
+        Releases the probe slot of a call that was cancelled before it finished.
+        """
+        self._probing = False
+
+    def record_failure(self, kind: str):
+        if kind not in (RATE_LIMIT, TRANSIENT):
+            # Gemini answered, so it is healthy even though the call failed.
+            self.record_success()
+            return
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self._probing = False
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+
+retry_budget = RetryBudget()
+gemini_breaker = CircuitBreaker()
+
+
+async def call_with_retries(attempt, on_retry=None, max_attempts: int = RETRY_MAX_ATTEMPTS):
+    """
+    Runs `attempt()` (an async callable) through the circuit breaker, retrying rate-limit,
+    transient and parse errors with backoff while the global retry budget allows.
+    Fatal errors are raised at once. Errors that did not come from the API are not
+    recorded on the breaker. `on_retry(error, kind)` is awaited before each retry.
+    """
+    retry_budget.deposit()
+    for attempt_no in range(max_attempts):
+        await gemini_breaker.before_call()
+        try:
+            result = await attempt()
+        except asyncio.CancelledError:
+            gemini_breaker.abandon()
+            raise
+        except Exception as e:
+            kind = classify(e)
+            if is_upstream(e):
+                gemini_breaker.record_failure(kind)
+            else:
+                gemini_breaker.abandon()
+            if kind == FATAL or attempt_no == max_attempts - 1:
+                raise
+            if not retry_budget.try_spend():
+                RETRY_BUDGET_EXHAUSTED.inc()
+                increment("retry_budget_exhausted")
+                print(f"Retry budget exhausted; not retrying {kind} error: {e}")
+                raise
+            delay = backoff_delay(kind, attempt_no, retry_after(e))
+            RETRIES.labels(kind).inc()
+            increment("retries")
+            increment(f"retries_{kind}")
+            print(f"{kind} error: {e}; retrying in {delay:.2f}s ({attempt_no + 1}/{max_attempts})...")
+            if on_retry is not None:
+                await on_retry(e, kind)
+            if delay:
+                with span("retry_backoff"):
+                    await asyncio.sleep(delay)
+            continue
+        gemini_breaker.record_success()
+        return result
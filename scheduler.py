@@ -0,0 +1,281 @@
+import os
+import re
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from .instrumentation import span
+
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_PER_REQUEST_CONCURRENCY = int(os.getenv("GEMINI_PER_REQUEST_CONCURRENCY", "4"))
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "300"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+# When set, the RPM/TPM buckets live in this SQLite file and are shared by every worker process.
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "")
+
+# Gemini bills each PDF page / image at roughly this many input tokens.
+TOKENS_PER_PAGE_IMAGE = 258
+
+TOKEN_PIECE_RE = re.compile(r"[A-Za-z]+|\d|[^\sA-Za-z\d]")
+
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+current_request_limit = contextvars.ContextVar("current_request_limit", default=None)
+
+
+def new_request_id(limit: int | None = None) -> str:
+    """
+    Starts a new scheduling scope for the current task and everything it spawns.
+    `limit` overrides the per-request concurrency limit for this scope.
+    """
+    request_id = uuid.uuid4().hex
+    current_request_id.set(request_id)
+    current_request_limit.set(limit)
+    return request_id
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Offline approximation of Gemini's tokenizer: every digit and punctuation mark is its
+    own token and a word costs one token per ~6 letters. Closer than len/4 on OCR text,
+    which is mostly numbers.
+    """
+    count = 0
+    for match in TOKEN_PIECE_RE.finditer(text):
+        piece = match.group()
+        count += 1 + (len(piece) - 1) // 6 if piece[0].isalpha() else 1
+    return count
+
+
+def estimate_prompt_tokens(text: str, num_pages: int = 1) -> int:
+    """
+    Input-token estimate of a prompt plus attached pages, used for TPM accounting and planning.
+    """
+    return estimate_tokens(text) + TOKENS_PER_PAGE_IMAGE * num_pages
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` tokens per minute.
+    The balance may go negative when actual usage exceeds the estimate; later
+    callers then wait until the debt is paid back.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: float = 1):
+        if amount <= 0 or self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount: float):
+        """
+        Debits (or credits, if negative) tokens after the fact.
+        """
+        self._refill()
+        self.tokens -= amount
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket whose balance is kept in SQLite, so all worker processes on the host
+    draw from one RPM/TPM quota. Each take is a short IMMEDIATE transaction run in a
+    worker thread; waiters within a process queue behind a local lock.
+    """
+
+    def __init__(self, path: str, name: str, per_minute: float):
+        self.name = name
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self._lock = asyncio.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "INSERT OR IGNORE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+            (name, per_minute, time.time()),
+        )
+
+    def _take(self, amount: float, force: bool = False) -> float:
+        """
+        Takes `amount` tokens if available (returns 0), otherwise returns the seconds to wait.
+        `force` takes them regardless, letting the balance go negative.
+        """
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated_at = self._conn.execute(
+                    "SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+                wait = 0.0
+                if force or tokens >= amount:
+                    tokens = min(self.capacity, tokens - amount)
+                else:
+                    wait = (amount - tokens) / self.rate
+                self._conn.execute(
+                    "UPDATE token_buckets SET tokens = ?, updated_at = ? WHERE name = ?", (tokens, now, self.name)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    async def acquire(self, amount: float = 1):
+        if amount <= 0 or self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                wait = await asyncio.to_thread(self._take, amount)
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+    def adjust(self, amount: float):
+        """
+        Debits (or credits, if negative) tokens after the fact, without blocking the event loop.
+        """
+        asyncio.get_running_loop().run_in_executor(None, self._take, amount, True)
+
+
+def _token_bucket(name: str, per_minute: float):
+    if SHARED_STATE_PATH:
+        return SharedTokenBucket(SHARED_STATE_PATH, name, per_minute)
+    return TokenBucket(per_minute)
+
+
+class FairScheduler:
+    """
+    Process-wide limiter for Gemini calls.
+    At most `max_concurrency` calls run at once and at most `per_request_limit`
+    of them belong to the same request. With SHARED_STATE_PATH set, the RPM and TPM
+    buckets are shared with the other worker processes. Free slots are handed out round-robin
+    across the requests that are waiting, so one large document cannot starve
+    small ones. Calls are additionally paced by RPM and TPM token buckets.
+    """
+
+    def __init__(self, max_concurrency: int, per_request_limit: int, rpm: float, tpm: float):
+        self.max_concurrency = max_concurrency
+        self.per_request_limit = per_request_limit
+        self.requests_bucket = _token_bucket("gemini_rpm", rpm)
+        self.tokens_bucket = _token_bucket("gemini_tpm", tpm)
+        self._active = 0
+        self._in_flight = {}
+        self._limits = {}
+        self._waiters = OrderedDict()
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": sum(len(q) for q in self._waiters.values()),
+            "requests_waiting": len(self._waiters),
+        }
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency and self._waiters:
+            granted = False
+            for request_id in list(self._waiters.keys()):
+                if self._in_flight.get(request_id, 0) >= self._limits.get(request_id, self.per_request_limit):
+                    continue
+                queue = self._waiters[request_id]
+                future = queue.popleft()
+                if queue:
+                    # Rotate this request to the back so the next slot goes to someone else.
+                    self._waiters.move_to_end(request_id)
+                else:
+                    del self._waiters[request_id]
+                if future.done():
+                    continue
+                future.set_result(None)
+                self._active += 1
+                self._in_flight[request_id] = self._in_flight.get(request_id, 0) + 1
+                granted = True
+                break
+            if not granted:
+                return
+
+    def _forget(self, request_id: str):
+        if request_id not in self._in_flight and request_id not in self._waiters:
+            self._limits.pop(request_id, None)
+
+    async def _acquire(self, request_id: str, limit: int | None):
+        if limit:
+            self._limits[request_id] = limit
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(request_id, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(request_id)
+            else:
+                queue = self._waiters.get(request_id)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiters[request_id]
+                self._forget(request_id)
+            raise
+
+    def _release(self, request_id: str):
+        self._active -= 1
+        remaining = self._in_flight.get(request_id, 1) - 1
+        if remaining > 0:
+            self._in_flight[request_id] = remaining
+        else:
+            self._in_flight.pop(request_id, None)
+            self._forget(request_id)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int = 0, requests: int = 1):
+        """
+        Holds one Gemini slot for the current request while the body runs.
+        """
+        request_id = current_request_id.get() or "anonymous"
+        with span("scheduler_wait"):
+            await self._acquire(request_id, current_request_limit.get())
+        try:
+            with span("rate_limit_wait"):
+                await self.requests_bucket.acquire(requests)
+                await self.tokens_bucket.acquire(estimated_tokens)
+            yield
+        finally:
+            self._release(request_id)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """
+        Corrects the TPM bucket once the real token count of a call is known.
+        """
+        self.tokens_bucket.adjust(actual_tokens - estimated_tokens)
+
+
+scheduler = FairScheduler(GEMINI_MAX_CONCURRENCY, GEMINI_PER_REQUEST_CONCURRENCY, GEMINI_RPM, GEMINI_TPM)
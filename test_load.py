@@ -0,0 +1,86 @@
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+import httpx
+
+# Usage: python test_load.py [concurrency] [total_requests] [document_url]
+BASE_URL = "http://localhost:8000"
+DEFAULT_DOCUMENT = "http://localhost:8081/TRAINING_SAMPLES/train_sample_1.pdf"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def run_load_test(concurrency: int, total: int, document: str):
+    """
+    Sends `total` extraction requests with `concurrency` in flight and, at the same time,
+    probes a cheap endpoint every 100ms. If the event loop is blocked by downloads,
+    uploads or file I/O, the probe latency climbs together with the extraction latency.
+    """
+    latencies = []
+    probe_latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    done = asyncio.Event()
+
+    async with httpx.AsyncClient(timeout=600) as client:
+
+        async def one_request():
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f"{BASE_URL}/extract-bill-data", json={"document": document})
+                    if response.status_code != 200 or not response.json().get("is_success"):
+                        failures += 1
+                except Exception as e:
+                    print(f"  [ERROR] {e}")
+                    failures += 1
+                latencies.append(time.perf_counter() - start)
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    await client.get(f"{BASE_URL}/openapi.json")
+                    probe_latencies.append(time.perf_counter() - start)
+                except Exception:
+                    pass
+                await asyncio.sleep(0.1)
+
+        probe_task = asyncio.create_task(probe())
+        start_time = time.perf_counter()
+        await asyncio.gather(*[one_request() for _ in range(total)])
+        wall_time = time.perf_counter() - start_time
+        done.set()
+        await probe_task
+
+    results = {
+        "concurrency": concurrency,
+        "requests": total,
+        "failures": failures,
+        "wall_time": round(wall_time, 2),
+        "throughput_rps": round(total / wall_time, 3) if wall_time else 0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_max": round(max(latencies, default=0), 3),
+        "probe_p50": round(statistics.median(probe_latencies), 4) if probe_latencies else None,
+        "probe_max": round(max(probe_latencies, default=0), 4),
+    }
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    document = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_DOCUMENT
+    asyncio.run(run_load_test(concurrency, total, document))
@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+# The modules use package-relative imports; make this checkout importable as
+# bill_extractor whatever its directory is called.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+os.environ.setdefault("DEBUG_LOG_PATH", os.devnull)
+if "bill_extractor" not in sys.modules:
+    package = types.ModuleType("bill_extractor")
+    package.__path__ = [ROOT]
+    sys.modules["bill_extractor"] = package
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from bill_extractor.backends import BackendRouter, ExtractionBackend, LocalTableBackend, analyze_page
+
+CLEAN_INVOICE = """CITY CARE HOSPITAL
+Invoice No: 4471          Date: 12-03-2025
+S.No  Description            Qty    Rate      Amount
+1     Paracetamol 500mg        2    10.00      20.00
+2     Room Rent General Ward   3  1,500.00   4,500.00
+3     X-Ray Chest PA           1   500.00     500.00
+4     Syringe 5ml             10     7.50      75.00
+Total                                        5,095.00
+"""
+
+TAX_AND_DISCOUNT = """CITY CARE HOSPITAL
+Invoice No: 4472          Date: 12-03-2025
+S.No  Description            Qty    Rate      Amount
+1     Paracetamol 500mg        2    10.00      20.00
+2     Room Rent General Ward   3  1,500.00   4,500.00
+3     X-Ray Chest PA           1   500.00     500.00
+Discount 10%                                 502.00
+CGST 6%                                      271.08
+SGST 6%                                      271.08
+Total                                        5,060.16
+"""
+
+
+class StubGemini(ExtractionBackend):
+    name = "gemini"
+
+    def confidence(self, text, source):
+        return 1.0
+
+    async def extract(self, load_pages, page_hashes, mime_type, page_texts, first_page):
+        raise AssertionError("not called")
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        ExtractionBackend()
+
+
+def test_clean_invoice_is_routed_locally():
+    router = BackendRouter([LocalTableBackend(), StubGemini()], mode="auto", min_confidence=0.9)
+    assert router.route([CLEAN_INVOICE], ["text_layer"]) == ["local"]
+
+
+def test_clean_invoice_rows():
+    analysis = analyze_page(CLEAN_INVOICE)
+    assert analysis["confidence"] == 1.0
+    assert analysis["total"] == 5095.0
+
+    data, usage = asyncio.run(LocalTableBackend().extract(None, ["h"], "application/pdf", [CLEAN_INVOICE], 3))
+    assert usage["total_tokens"] == 0
+    [page] = data["pagewise_line_items"]
+    assert page["page_no"] == "3"
+    assert page["bill_items"] == [
+        {"item_name": "Paracetamol 500mg", "item_amount": 20.0, "item_rate": 10.0, "item_quantity": 2.0},
+        {"item_name": "Room Rent General Ward", "item_amount": 4500.0, "item_rate": 1500.0, "item_quantity": 3.0},
+        {"item_name": "X-Ray Chest PA", "item_amount": 500.0, "item_rate": 500.0, "item_quantity": 1.0},
+        {"item_name": "Syringe 5ml", "item_amount": 75.0, "item_rate": 7.5, "item_quantity": 10.0},
+    ]
+    assert data["total_item_count"] == 4
+
+
+def test_numbers_in_item_names_are_kept():
+    page = CLEAN_INVOICE.replace("Paracetamol 500mg ", "Paracetamol 500   ")
+    analysis = analyze_page(page)
+    assert analysis["rows"][0]["item_name"] == "Paracetamol 500"
+    assert analysis["rows"][0]["item_quantity"] == 2.0
+    assert analysis["confidence"] == 1.0
+
+    # A stray number between quantity and rate leaves the row unvalidated.
+    stray = CLEAN_INVOICE.replace("Paracetamol 500mg        2", "Paracetamol 500mg   2    7")
+    assert analyze_page(stray)["confidence"] < 0.9
+
+
+def test_tax_and_discount_page_stays_on_gemini():
+    router = BackendRouter([LocalTableBackend(), StubGemini()], mode="auto", min_confidence=0.9)
+    assert analyze_page(TAX_AND_DISCOUNT)["confidence"] == 0.0
+    assert router.route([TAX_AND_DISCOUNT, CLEAN_INVOICE], ["text_layer", "ocr"]) == ["gemini", "local"]
+
+
+def test_failed_ocr_and_forced_modes():
+    auto = BackendRouter([LocalTableBackend(), StubGemini()], mode="auto", min_confidence=0.9)
+    assert auto.choose(CLEAN_INVOICE, "ocr_failed") == "gemini"
+    forced = BackendRouter([LocalTableBackend(), StubGemini()], mode="gemini", min_confidence=0.9)
+    assert forced.choose(CLEAN_INVOICE, "text_layer") == "gemini"
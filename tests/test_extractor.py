@@ -0,0 +1,43 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from bill_extractor import classifier, extractor
+
+USAGE = {"total_tokens": 10, "input_tokens": 8, "output_tokens": 2}
+
+
+def test_pages_left_out_of_a_complete_output_are_not_rerequested(monkeypatch):
+    calls = []
+
+    async def extract_with_gemini(source, content_hash, mime_type, ocr_context):
+        calls.append(content_hash)
+        page = {"page_no": "1", "page_type": "Bill Detail", "bill_items": [{"item_name": "X-Ray", "item_amount": 500.0}]}
+        return {"pages": [page], "partial_page": None, "complete": True}, dict(USAGE)
+
+    monkeypatch.setattr(extractor, "_extract_with_gemini", extract_with_gemini)
+    texts = ["X-Ray 500.00", "FINAL BILL\nGrand Total 500.00"]
+    assigned, usage, truncated = asyncio.run(extractor._extract_assigned(b"%PDF", "h", "application/pdf", texts, 1))
+
+    assert calls == ["h"]
+    assert truncated is None
+    assert sorted(assigned) == [1, 2]
+    assert assigned[2]["page_no"] == "2"
+    assert assigned[2]["bill_items"] == []
+
+
+def test_classifier_tokens_are_returned(monkeypatch):
+    class Model:
+        async def generate_content_async(self, prompt):
+            return SimpleNamespace(text=json.dumps({"1": "irrelevant"}), usage_metadata=SimpleNamespace(
+                total_token_count=30, prompt_token_count=25, candidates_token_count=5))
+
+    monkeypatch.setattr(classifier, "CLASSIFIER_MODEL", "small-model")
+    monkeypatch.setattr(classifier, "_get_model", Model)
+    monkeypatch.setattr(extractor, "CLASSIFIER_ENABLED", True)
+    texts = ["Notes written about the visit of the patient, nothing else here",
+             "HOSPITAL BILL\nX-Ray Chest 500.00\nRoom Rent 1500.00\nTotal 2000.00"]
+    skip, usage = asyncio.run(extractor._skipped_pages(texts, ["text_layer", "text_layer"]))
+
+    assert skip == {0}
+    assert usage == {"total_tokens": 30, "input_tokens": 25, "output_tokens": 5}
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from bill_extractor import extractor, jobs
+from bill_extractor.cache import ResultCache, hash_bytes
+from bill_extractor.jobs import JobRunner, JobStore, COMPLETED
+from bill_extractor.utils import DocumentBuffer
+
+PDF = b"%PDF-1.4 cached bill"
+CACHED = {
+    "pagewise_line_items": [
+        {"page_no": "1", "page_type": "Bill Detail",
+         "bill_items": [{"item_name": "X-Ray", "item_amount": 500.0, "item_rate": 500.0, "item_quantity": 1}]},
+    ],
+    "total_item_count": 1,
+}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+def run_job(store: JobStore, document: str) -> dict:
+    job_id = store.create(document)
+    job = store.claim_next()
+    assert job["id"] == job_id
+    asyncio.run(JobRunner(store, workers=0)._run(job))
+    return store.get(job_id)
+
+
+def test_job_for_cached_document_keeps_its_pages(store, tmp_path, monkeypatch):
+    async def download(url, on_headers=None):
+        return DocumentBuffer(".pdf", data=PDF)
+
+    monkeypatch.setattr(extractor, "download_document", download)
+    monkeypatch.setattr(extractor, "result_cache", ResultCache(str(tmp_path / "cache.db"), 3600, 10 ** 7))
+    asyncio.run(extractor._cache_set(hash_bytes(PDF), "document", CACHED))
+
+    result = run_job(store, "http://example.com/bill.pdf")
+    assert result["status"] == COMPLETED
+    assert result["total_item_count"] == 1
+    assert result["pagewise_line_items"] == CACHED["pagewise_line_items"]
+    assert result["chunks_done"] == 1
+
+
+def test_resumed_job_combines_checkpoints_with_new_chunks(store, monkeypatch):
+    plan = [{"start": 0, "end": 1}, {"start": 1, "end": 2}]
+    usage = {"total_tokens": 10, "input_tokens": 8, "output_tokens": 2}
+    calls = []
+
+    async def iter_document(url, completed_chunks=None, plan=None):
+        calls.append((completed_chunks, plan))
+        yield {"event": "progress", "stage": "planned", "chunk_plan": plan, "chunks_total": len(plan)}
+        yield {"event": "page", "chunk": 1, "page": {"page_no": "2", "page_type": "Final Bill",
+                                                     "bill_items": [{"item_name": "B"}, {"item_name": "C"}]}}
+        yield {"event": "progress", "stage": "chunk_done", "chunk": 1, "token_usage": usage,
+               "chunks_done": 2, "chunks_total": 2}
+        yield {"event": "summary", "total_item_count": 2, "token_usage": usage, "metadata": {}}
+
+    monkeypatch.setattr(jobs, "iter_document", iter_document)
+    job_id = store.create("http://example.com/bill.pdf")
+    store.save_plan(job_id, plan)
+    store.save_chunk(job_id, 0, [{"page_no": "1", "page_type": "Bill Detail", "bill_items": [{"item_name": "A"}]}], usage)
+    job = store.claim_next()
+    asyncio.run(JobRunner(store, workers=0)._run(job))
+
+    assert calls == [({0}, plan)]
+    result = store.get(job_id)
+    assert result["status"] == COMPLETED
+    assert [page["page_no"] for page in result["pagewise_line_items"]] == ["1", "2"]
+    assert result["total_item_count"] == 3
+    assert result["token_usage"]["total_tokens"] == 20
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from bill_extractor.parsing import OutputParser, OutputParseError, assign_pages, complete_page
+
+
+def parse(text: str, step: int = 7) -> dict:
+    parser = OutputParser()
+    for i in range(0, len(text), step):
+        parser.feed(text[i:i + step])
+    return parser.finish()
+
+
+def document(*pages) -> str:
+    return json.dumps({"pagewise_line_items": list(pages), "total_item_count": 0})
+
+
+def page(no, *rows, page_type="Bill Detail"):
+    return {"page_no": no, "page_type": page_type, "bill_items": list(rows)}
+
+
+def test_parses_compact_rows():
+    result = parse(document(page("1", ["Paracetamol", 20.0, 10.0, 2], ["Gauze", 5])))
+    assert result["complete"]
+    assert result["partial_page"] is None
+    [parsed] = result["pages"]
+    assert parsed["bill_items"] == [
+        {"item_name": "Paracetamol", "item_amount": 20.0, "item_rate": 10.0, "item_quantity": 2},
+        {"item_name": "Gauze", "item_amount": 5, "item_rate": None, "item_quantity": 1},
+    ]
+
+
+def test_ignores_code_fences_and_surrounding_text():
+    text = "Here you go:\n```json\n" + document(page("1", ["X-Ray", 500])) + "\n```\nDone."
+    result = parse(text)
+    assert result["complete"]
+    assert [item["item_name"] for item in result["pages"][0]["bill_items"]] == ["X-Ray"]
+
+
+def test_skips_stray_closing_brackets():
+    text = '{"pagewise_line_items":[{"page_no":"1","page_type":"Bill Detail","bill_items":[["Bed",100]]}}],"total_item_count":1}'
+    result = parse(text)
+    assert result["complete"]
+    assert result["pages"][0]["bill_items"][0]["item_name"] == "Bed"
+
+
+def test_brackets_and_quotes_inside_strings():
+    name = 'Dressing {large} [pack] "sterile"'
+    result = parse(document(page("1", [name, 75.5], ["ICU ]} charges", 1200])))
+    assert [item["item_name"] for item in result["pages"][0]["bill_items"]] == [name, "ICU ]} charges"]
+
+
+def test_repairs_trailing_commas_and_bare_decimals():
+    text = '{"pagewise_line_items":[{"page_no":"1","page_type":"Pharmacy","bill_items":[["Syrup",4.,4.,1],],},],"total_item_count":1}'
+    result = parse(text)
+    assert result["pages"][0]["bill_items"] == [
+        {"item_name": "Syrup", "item_amount": 4.0, "item_rate": 4.0, "item_quantity": 1}
+    ]
+
+
+def test_rejects_rows_without_a_name():
+    parser = OutputParser()
+    parser.feed(document(page("1", [None, 10], ["", 5], ["Valid", 1])))
+    result = parser.finish()
+    assert [item["item_name"] for item in result["pages"][0]["bill_items"]] == ["Valid"]
+    assert parser.rows_rejected == 2
+
+
+def test_recovers_rows_of_a_truncated_page():
+    text = document(page("1", ["A", 1]), page("2", ["B", 2], ["C", 3], ["D", 4]))
+    cut = text.index('["D"') + 3
+    result = parse(text[:cut])
+    assert not result["complete"]
+    assert len(result["pages"]) == 1
+    assert [item["item_name"] for item in result["partial_page"]["bill_items"]] == ["B", "C"]
+
+
+def test_truncated_page_without_page_type_is_completed():
+    text = '{"pagewise_line_items":[{"page_no":"1","bill_items":[["A",1],["B",2],["C'
+    result = parse(text)
+    partial = result["partial_page"]
+    assert "page_type" not in partial
+    completed = complete_page(partial, 4, "Pharmacy")
+    assert completed["page_no"] == "4"
+    assert completed["page_type"] == "Pharmacy"
+    assert len(completed["bill_items"]) == 2
+
+
+def test_no_usable_page_raises():
+    with pytest.raises(OutputParseError):
+        parse("I could not read this document.")
+
+
+def test_assign_pages_absolute_numbers():
+    assigned = assign_pages([page("6", ["A", 1]), page("5", ["B", 2])], [5, 6])
+    assert sorted(assigned) == [5, 6]
+    assert assigned[5]["bill_items"] == [["B", 2]]
+
+
+def test_assign_pages_relative_numbers_are_rewritten():
+    assigned = assign_pages([page("1"), page("Page 2")], [11, 12])
+    assert {n: p["page_no"] for n, p in assigned.items()} == {11: "11", 12: "12"}
+
+
+def test_assign_pages_without_numbers_uses_order():
+    assigned = assign_pages([page(None), page("")], [3, 4, 5])
+    assert {n: p["page_no"] for n, p in assigned.items()} == {3: "3", 4: "4"}
+
+
+def test_assign_pages_merges_entries_of_the_same_page():
+    assigned = assign_pages([page("2", ["A", 1]), page("2", ["B", 2])], [2])
+    assert assigned[2]["bill_items"] == [["A", 1], ["B", 2]]
+
+
+def test_assign_pages_fills_missing_page_type():
+    pages = [{"page_no": "1", "bill_items": []}, {"page_no": "2", "page_type": "", "bill_items": []}]
+    assigned = assign_pages(pages, [1, 2], ["Final Bill", "Pharmacy"])
+    assert assigned[1]["page_type"] == "Final Bill"
+    assert assigned[2]["page_type"] == "Pharmacy"
+    assert assign_pages([{"page_no": "1"}], [1])[1] == {"page_no": "1", "page_type": "Bill Detail", "bill_items": []}
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+
+from bill_extractor import uploads
+from bill_extractor.uploads import UploadManager
+
+
+class FakeClient:
+    def __init__(self):
+        self.uploaded = 0
+        self.deleted = []
+
+    def upload_file(self, upload, mime_type=None):
+        self.uploaded += 1
+        return SimpleNamespace(name=f"files/{self.uploaded}")
+
+    def delete_file(self, name):
+        self.deleted.append(name)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+DATA = b"x" * (uploads.INLINE_MAX_BYTES + 1)
+
+
+def test_small_content_is_sent_inline():
+    async def run():
+        manager = UploadManager(FakeClient())
+        handle = await manager.acquire("h", b"small", "application/pdf")
+        assert handle.part == {"mime_type": "application/pdf", "data": b"small"}
+        manager.release(handle)
+    asyncio.run(run())
+
+
+def test_file_is_reused_and_counted_per_handle():
+    async def run():
+        client = FakeClient()
+        manager = UploadManager(client)
+        first = await manager.acquire("h", DATA, "application/pdf")
+        second = await manager.acquire("h", DATA, "application/pdf")
+        assert client.uploaded == 1
+        assert first.part is second.part
+        manager.release(first)
+        manager.release(first)  # a second release of the same handle is ignored
+        assert first.entry is None and second.entry["users"] == 1
+        manager.release(second)
+    asyncio.run(run())
+
+
+def test_reupload_keeps_old_file_until_its_holders_release(monkeypatch):
+    async def run():
+        client = FakeClient()
+        manager = UploadManager(client)
+        old = await manager.acquire("h", DATA, "application/pdf")
+        monkeypatch.setattr(uploads, "UPLOAD_REUSE_SECONDS", 0)
+        new = await manager.acquire("h", DATA, "application/pdf")
+        assert client.uploaded == 2
+
+        # Releasing the old handle must not touch the new file's count.
+        manager.release(old)
+        await settle()
+        assert client.deleted == ["files/1"]
+        assert new.entry["users"] == 1
+
+        manager.sweep()
+        await settle()
+        assert client.deleted == ["files/1"]
+        manager.release(new)
+    asyncio.run(run())
+
+
+def test_renew_replaces_a_rejected_file():
+    async def run():
+        client = FakeClient()
+        manager = UploadManager(client)
+        handle = await manager.acquire("h", DATA, "application/pdf")
+        other = await manager.acquire("h", DATA, "application/pdf")
+        await manager.renew(handle, DATA, "application/pdf")
+        assert handle.part.name == "files/2"
+        await settle()
+        assert client.deleted == []  # still used by `other`
+        manager.release(other)
+        await settle()
+        assert client.deleted == ["files/1"]
+        manager.release(handle)
+        await manager.stop()
+        assert client.deleted == ["files/1", "files/2"]
+    asyncio.run(run())
@@ -0,0 +1,181 @@
+import io
+import os
+import time
+import asyncio
+
+import google.generativeai as genai
+
+from .scheduler import scheduler
+from .instrumentation import span, increment, UPLOADS
+from .retry import call_with_retries
+
+# Gemini keeps uploaded files for 48 hours; stop reusing them well before that.
+UPLOAD_REUSE_SECONDS = float(os.getenv("UPLOAD_REUSE_SECONDS", str(46 * 3600)))
+UPLOAD_IDLE_SECONDS = float(os.getenv("UPLOAD_IDLE_SECONDS", "600"))
+UPLOAD_SWEEP_SECONDS = float(os.getenv("UPLOAD_SWEEP_SECONDS", "60"))
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", str(1024 * 1024)))
+
+
+class UploadHandle:
+    """
+    One use of an uploaded file (or of an inline part). `part` goes into generate_content;
+    the handle is given back to release() when the call is done.
+    """
+
+    def __init__(self, part, entry: dict | None = None):
+        self.part = part
+        self.entry = entry
+
+
+class UploadManager:
+    """
+    Caches Gemini file references by content hash. A document or chunk is uploaded once
+    and reused across retries and repeated requests while it is fresh; files nobody has
+    used for UPLOAD_IDLE_SECONDS are deleted in the background. In-memory content up to
+    INLINE_MAX_BYTES is sent inline with the request instead of being uploaded.
+
+    Users are counted per uploaded file, not per hash: a file replaced by a newer upload
+    of the same content is retired and deleted once its last handle is released.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._entries = {}
+        self._retired = []
+        self._in_flight = {}
+        self._deleting = set()
+        self._sweeper = None
+
+    def start(self):
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        """
+        Stops the sweeper and deletes every remaining uploaded file.
+        """
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        entries = list(self._entries.values()) + self._retired
+        self._entries, self._retired = {}, []
+        await asyncio.gather(*[self._delete(entry["file"]) for entry in entries], return_exceptions=True)
+
+    async def acquire(self, content_hash: str, source, mime_type: str) -> UploadHandle:
+        """
+        Returns a handle to a content part for generate_content: an inline blob for small
+        in-memory content, otherwise a (possibly reused) file reference. Every handle must
+        be given back to release().
+        """
+        if isinstance(source, bytes) and len(source) <= INLINE_MAX_BYTES:
+            UPLOADS.labels("inline").inc()
+            increment("inline_parts")
+            return UploadHandle({"mime_type": mime_type, "data": source})
+
+        entry = self._entries.get(content_hash)
+        if entry is not None and time.time() - entry["uploaded_at"] < UPLOAD_REUSE_SECONDS:
+            UPLOADS.labels("reused").inc()
+            increment("uploads_reused")
+        else:
+            if content_hash not in self._in_flight:
+                self._in_flight[content_hash] = asyncio.ensure_future(self._upload(content_hash, source, mime_type))
+            try:
+                entry = await asyncio.shield(self._in_flight[content_hash])
+            finally:
+                self._in_flight.pop(content_hash, None)
+
+        entry["users"] += 1
+        entry["last_used"] = time.time()
+        return UploadHandle(entry["file"], entry)
+
+    def release(self, handle: UploadHandle):
+        entry, handle.entry = handle.entry, None
+        if entry is None:
+            return
+        entry["users"] = max(0, entry["users"] - 1)
+        entry["last_used"] = time.time()
+        if entry["retired"] and not entry["users"]:
+            self._retired.remove(entry)
+            self._schedule_delete(entry["file"])
+
+    def invalidate(self, handle: UploadHandle):
+        """
+        Forgets the file of `handle`, which the API no longer accepts, so the next acquire
+        uploads again. The file is deleted once its last handle is released.
+        """
+        if handle.entry is not None:
+            self._retire(handle.entry)
+
+    async def renew(self, handle: UploadHandle, source, mime_type: str):
+        """
+        Points `handle` at a fresh upload of the same content after the API rejected its file.
+        """
+        entry = handle.entry
+        if entry is None:
+            return
+        self.invalidate(handle)
+        self.release(handle)
+        fresh = await self.acquire(entry["hash"], source, mime_type)
+        handle.part, handle.entry = fresh.part, fresh.entry
+
+    def _retire(self, entry: dict):
+        if entry["retired"]:
+            return
+        entry["retired"] = True
+        if self._entries.get(entry["hash"]) is entry:
+            del self._entries[entry["hash"]]
+        if entry["users"]:
+            self._retired.append(entry)
+        else:
+            self._schedule_delete(entry["file"])
+
+    async def _upload(self, content_hash: str, source, mime_type: str) -> dict:
+        async def attempt():
+            upload = io.BytesIO(source) if isinstance(source, bytes) else source
+            async with scheduler.slot(requests=0):
+                with span("upload"):
+                    return await asyncio.to_thread(self.client.upload_file, upload, mime_type=mime_type)
+
+        file_ref = await call_with_retries(attempt)
+        UPLOADS.labels("uploaded").inc()
+        increment("uploads")
+
+        previous = self._entries.get(content_hash)
+        if previous is not None:
+            self._retire(previous)
+        now = time.time()
+        entry = {"file": file_ref, "hash": content_hash, "uploaded_at": now, "last_used": now, "users": 0,
+                 "retired": False}
+        self._entries[content_hash] = entry
+        return entry
+
+    def sweep(self):
+        """
+        Deletes files that are idle or too old to reuse and no longer in use.
+        """
+        now = time.time()
+        for entry in list(self._entries.values()):
+            if entry["users"]:
+                continue
+            if now - entry["last_used"] > UPLOAD_IDLE_SECONDS or now - entry["uploaded_at"] > UPLOAD_REUSE_SECONDS:
+                self._retire(entry)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(UPLOAD_SWEEP_SECONDS)
+            self.sweep()
+
+    def _schedule_delete(self, file_ref):
+        task = asyncio.ensure_future(self._delete(file_ref))
+        self._deleting.add(task)
+        task.add_done_callback(self._deleting.discard)
+
+    async def _delete(self, file_ref):
+        try:
+            await asyncio.to_thread(self.client.delete_file, file_ref.name)
+            UPLOADS.labels("deleted").inc()
+        except Exception as e:
+            print(f"Failed to delete uploaded file {file_ref.name}: {e}")
+
+
+upload_manager = UploadManager(genai)
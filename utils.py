@@ -1,42 +1,195 @@
-import requests
+import io
 import os
+import queue
+import atexit
+import asyncio
+import logging
 import tempfile
+import logging.handlers
 from urllib.parse import urlparse
 
-def download_file(url: str) -> str:
+import httpx
+import PyPDF2
+
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "60"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+DEBUG_LOG_PATH = os.getenv("DEBUG_LOG_PATH", "debug_log.txt")
+MEMORY_SPILL_THRESHOLD_BYTES = int(os.getenv("MEMORY_SPILL_THRESHOLD_BYTES", str(64 * 1024 * 1024)))
+
+_http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared keep-alive HTTP client, creating it on first use.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT_SECONDS,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """
+    Closes the shared HTTP client (called on application shutdown).
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _setup_debug_log() -> logging.Logger:
+    """
+    The debug log is written by a background listener thread, so logging from
+    request handlers never blocks the event loop on file I/O.
+    """
+    logger = logging.getLogger("bill_extractor.debug")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    file_handler = logging.FileHandler(DEBUG_LOG_PATH, encoding="utf-8", delay=True)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+
+debug_log = _setup_debug_log()
+
+
+def _extension_for(url: str, content_type: str) -> str:
+    ext = os.path.splitext(urlparse(url).path)[1]
+    if ext:
+        return ext
+    content_type = content_type.split(';')[0].strip()
+    if content_type == 'application/pdf':
+        return '.pdf'
+    if content_type in ['image/jpeg', 'image/jpg']:
+        return '.jpg'
+    if content_type == 'image/png':
+        return '.png'
+    return ''
+
+
+class DocumentBuffer:
     """
-    Downloads a file from a URL to a temporary file and returns the path.
+    A downloaded document. Held in memory as bytes, or in a temporary file when it
+    was larger than MEMORY_SPILL_THRESHOLD_BYTES.
     """
+
+    def __init__(self, ext: str, data: bytes | None = None, path: str | None = None):
+        self.ext = ext.lower()
+        self.data = data
+        self.path = path
+
+    @property
+    def mime_type(self) -> str:
+        if self.ext == ".pdf":
+            return "application/pdf"
+        if self.ext == ".png":
+            return "image/png"
+        return "image/jpeg"
+
+    @property
+    def source(self):
+        """
+        The bytes of an in-memory document, or the path of a spilled one.
+        """
+        return self.data if self.data is not None else self.path
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def open(self):
+        """
+        Returns a binary file object over the document without copying in-memory data.
+        """
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, 'rb')
+
+    def close(self):
+        if self.path:
+            cleanup_file(self.path)
+            self.path = None
+        self.data = None
+
+
+async def download_document(url: str, on_headers=None) -> DocumentBuffer:
+    """
+    Downloads a document into memory with the shared async client.
+    Once the body exceeds MEMORY_SPILL_THRESHOLD_BYTES it continues into a temporary
+    file instead (writes run in a worker thread).
+    `on_headers(content_length)` is awaited before the body is read (content_length is
+    None when the server does not send one); its errors are raised unchanged.
+    """
+    temp_path = None
+    f = None
+    hook_error = None
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-
-        parsed_url = urlparse(url)
-        path = parsed_url.path
-        ext = os.path.splitext(path)[1]
-        
-        if not ext:
-            content_type = response.headers.get('content-type')
-            if content_type == 'application/pdf':
-                ext = '.pdf'
-            elif content_type in ['image/jpeg', 'image/jpg']:
-                ext = '.jpg'
-            elif content_type == 'image/png':
-                ext = '.png'
-            else:
-                ext = ''
-
-
-        fd, temp_path = tempfile.mkstemp(suffix=ext)
-        with os.fdopen(fd, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        return temp_path
+        client = get_http_client()
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            ext = _extension_for(url, response.headers.get('content-type', ''))
+            if on_headers is not None:
+                length = response.headers.get('content-length', '')
+                try:
+                    await on_headers(int(length) if length.isdigit() else None)
+                except Exception as e:
+                    hook_error = e
+                    raise
+
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes(chunk_size=65536):
+                if f is None:
+                    buffer += chunk
+                    if len(buffer) > MEMORY_SPILL_THRESHOLD_BYTES:
+                        fd, temp_path = tempfile.mkstemp(suffix=ext)
+                        f = os.fdopen(fd, 'wb')
+                        await asyncio.to_thread(f.write, buffer)
+                        buffer = None
+                else:
+                    await asyncio.to_thread(f.write, chunk)
+
+        if f is not None:
+            f.close()
+            return DocumentBuffer(ext, path=temp_path)
+        return DocumentBuffer(ext, data=bytes(buffer))
     except Exception as e:
+        if f is not None:
+            f.close()
+        if temp_path:
+            cleanup_file(temp_path)
+        if e is hook_error:
+            raise
         raise Exception(f"Failed to download file: {str(e)}")
 
+
+def select_pdf_pages(reader, page_indices) -> bytes:
+    """
+    Returns the given 0-based pages of an open PyPDF2 reader as a standalone in-memory PDF.
+    """
+    writer = PyPDF2.PdfWriter()
+    for page_num in page_indices:
+        writer.add_page(reader.pages[page_num])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def slice_pdf(reader, start: int, end: int) -> bytes:
+    """
+    Returns pages [start, end) of an open PyPDF2 reader as a standalone in-memory PDF.
+    """
+    return select_pdf_pages(reader, range(start, end))
+
 def cleanup_file(path: str):
     """
     Removes the temporary file.